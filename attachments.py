@@ -0,0 +1,256 @@
+# a prompt can list several files, directories, globs and urls, e.g.
+#   scans/ notes/*.pdf "my report.pdf#pages=3-7" https://example.com/paper.pdf
+# they are loaded in parallel and sent as the parts of one user content
+import os, re, glob, shlex
+import mimetypes
+import threading, contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import filehandling, preprocess, metrics
+from deferred import DeferredPart
+
+
+class Attachment:
+    def __init__(self, name, make_loader, pages=None) -> None:
+        self.name = name
+        self.pages = pages
+        # loaders keep per file state, every attachment gets its own
+        self.make_loader = make_loader
+        self.mimetype = None
+        self.data = None
+        self.error = None
+        self.part = None
+        # a large local file is not read, only hashed and uploaded from its path
+        self.path = None
+        self.digest = None
+        self.file_size = 0
+        # set once the attachment has its part or was rejected
+        self.ready = threading.Event()
+
+    @property
+    def size(self):
+        return len(self.data) if self.data is not None else self.file_size
+
+
+# stands in for an attachment that is still loading in the background. Until
+# then mime_type is guessed from the name, so routing and the context estimate
+# can look at it. Resolves to None if the attachment was rejected.
+class PendingPart(DeferredPart):
+    digest = None
+
+    def __init__(self, attachment) -> None:
+        self.attachment = attachment
+        self.description = attachment.name
+
+    @property
+    def mime_type(self):
+        return self.attachment.mimetype or mimetypes.guess_type(self.attachment.name)[0] or ""
+
+    @property
+    def size(self):
+        return self.attachment.size or None
+
+    def done(self):
+        return self.attachment.ready.is_set()
+
+    def failed(self):
+        return self.done() and self.attachment.part is None
+
+    def resolve(self):
+        self.attachment.ready.wait()
+        return self.attachment.part
+
+
+# "report.pdf#pages=3-7,9" -> ("report.pdf", "3-7,9")
+def split_pages(token):
+    if match := re.fullmatch(r"(.+)#pages=([\d,\- ]+)", token):
+        return match.group(1), match.group(2)
+    return token, None
+
+
+def expand_token(token):
+    path = os.path.expanduser(token)
+    if os.path.isdir(path):
+        return sorted(entry.path for entry in os.scandir(path) if entry.is_file() and not entry.name.startswith("."))
+    if os.path.isfile(path):
+        return [path]
+    if glob.has_magic(path):
+        return sorted(name for name in glob.glob(path, recursive=True) if os.path.isfile(name))
+    return []
+
+
+# returns the attachments named by the prompt, or None if it is not a list of
+# attachments. make_local_loader and make_url_loader build a fresh FileLoader.
+def expand(prompt, make_local_loader, make_url_loader):
+    # a single path keeps working unquoted, even with spaces in it
+    path, pages = split_pages(prompt.strip())
+    if name := make_local_loader().validate(path):
+        return [Attachment(name, make_local_loader, pages)]
+    if name := make_url_loader().validate(path):
+        return [Attachment(name, make_url_loader, pages)]
+
+    try:
+        tokens = shlex.split(prompt)
+    except ValueError:
+        return None
+    if not tokens:
+        return None
+
+    attachments, seen, unmatched = [], set(), []
+    for token in tokens:
+        token, pages = split_pages(token)
+        if token.startswith(("http://", "https://")):
+            names, make_loader = [token], make_url_loader
+        else:
+            names, make_loader = expand_token(token), make_local_loader
+            if not names and glob.has_magic(token):
+                unmatched.append(token)
+            elif not names and not os.path.isdir(os.path.expanduser(token)):
+                return None
+        for name in names:
+            if (name, pages) not in seen:
+                seen.add((name, pages))
+                attachments.append(Attachment(name, make_loader, pages))
+
+    # a glob without matches is reported, unless the prompt named nothing else
+    if unmatched and not attachments:
+        return None
+    for token in unmatched:
+        attachment = Attachment(token, make_local_loader)
+        attachment.error = "no matching files"
+        attachments.append(attachment)
+    return attachments
+
+
+# loads and preprocesses attachments on a thread pool, then turns them into
+# parts. All parts go into one request, so once the inline ones add up to
+# inline_budget_mb the larger files are sent through the Files API instead.
+# Local files above the upload threshold that need no preprocessing are
+# streamed from disk, the payload never sits in memory as a whole.
+class AttachmentLoader:
+    def __init__(self, gemini, allowed_mimetypes, preprocessor=None, workers=8, inline_budget_mb=15, stream_from_disk=True) -> None:
+        self.gemini = gemini
+        self.allowed_mimetypes = allowed_mimetypes
+        self.preprocessor = preprocessor
+        self.workers = workers
+        self.inline_budget = inline_budget_mb * 1024 * 1024
+        self.stream_from_disk = stream_from_disk
+
+    def can_stream(self, attachment):
+        if not self.stream_from_disk or attachment.pages or not os.path.isfile(attachment.name):
+            return False
+        size = os.path.getsize(attachment.name)
+        if size <= self.gemini.upload_threshold_mb * 1024 * 1024:
+            return False
+        return not (self.preprocessor and self.preprocessor.make_step(attachment.mimetype, size))
+
+    def load(self, attachment):
+        loader = attachment.make_loader()
+        try:
+            with metrics.stage("mimetype_probe"):
+                attachment.mimetype = loader.get_mimetype(attachment.name)
+            if attachment.mimetype not in self.allowed_mimetypes:
+                loader.discard(attachment.name)
+                attachment.error = f"non allowed mimetype {attachment.mimetype}"
+                return attachment
+            if self.can_stream(attachment):
+                loader.discard(attachment.name)
+                attachment.path = attachment.name
+                attachment.file_size = os.path.getsize(attachment.path)
+                with metrics.stage("file_load"):
+                    attachment.digest = filehandling.hash_file(attachment.path)
+                return attachment
+            with metrics.stage("file_load"):
+                attachment.data = loader.load(attachment.name)
+            if self.preprocessor:
+                with metrics.stage("preprocess"):
+                    attachment.data, attachment.mimetype = self.preprocessor.process(attachment.data, attachment.mimetype, attachment.pages)
+            elif attachment.pages:
+                attachment.error = "page ranges need preprocessing"
+        except (filehandling.FileLoadError, OSError) as e:
+            attachment.error = str(e) or type(e).__name__
+        except preprocess.PreprocessError as e:
+            attachment.error = str(e)
+        if attachment.error:
+            attachment.data = attachment.path = None
+        return attachment
+
+    def make_part(self, attachment, upload):
+        import gemini_search
+        try:
+            with metrics.stage("upload" if upload or attachment.path else "file_load"):
+                if attachment.path:
+                    attachment.part = self.gemini.make_file_part_from_path(attachment.path, attachment.mimetype, attachment.digest, attachment.file_size)
+                else:
+                    attachment.part = self.gemini.make_file_part(attachment.data, attachment.mimetype, upload=upload)
+        except gemini_search.UploadError as e:
+            attachment.error = f"upload failed: {e}"
+        except OSError as e:
+            attachment.error = str(e)
+        finally:
+            attachment.ready.set()
+        return attachment.part
+
+    def plan_uploads(self, attachments):
+        inline_size, uploads = 0, set()
+        for attachment in sorted(attachments, key=lambda attachment: attachment.size):
+            if attachment.path:
+                uploads.add(attachment.name)
+            elif inline_size + attachment.size <= self.inline_budget:
+                inline_size += attachment.size
+            else:
+                uploads.add(attachment.name)
+        return uploads
+
+    # worker threads do not inherit the context, the stages they measure would
+    # not reach the metrics of the request
+    @staticmethod
+    def _submit(executor, function, *args):
+        return executor.submit(contextvars.copy_context().run, function, *args)
+
+    # on_progress(done, total) is called after every loaded or uploaded file,
+    # returns the parts in prompt order and the rejected attachments
+    def run(self, attachments, on_progress=lambda done, total: None):
+        pending = [attachment for attachment in attachments if attachment.error is None]
+        done, total = 0, len(pending)
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for future in as_completed([self._submit(executor, self.load, attachment) for attachment in pending]):
+                    if (attachment := future.result()).error is not None:
+                        attachment.ready.set()
+                    done += 1
+                    on_progress(done, total)
+
+                accepted = [attachment for attachment in pending if attachment.error is None]
+                uploads = self.plan_uploads(accepted)
+                total += len(uploads)
+                on_progress(done, total)
+                futures = {self._submit(executor, self.make_part, attachment, attachment.name in uploads): attachment for attachment in accepted}
+                for future in as_completed(futures):
+                    future.result()
+                    if futures[future].name in uploads:
+                        done += 1
+                        on_progress(done, total)
+        finally:
+            # nobody waits forever on an attachment the run did not get to
+            for attachment in attachments:
+                if attachment.part is None and attachment.error is None:
+                    attachment.error = "loading was interrupted"
+                attachment.ready.set()
+
+        parts = [attachment.part for attachment in attachments if attachment.part is not None]
+        return parts, [attachment for attachment in attachments if attachment.error is not None]
+
+    # returns right away with a PendingPart per attachment, the files are loaded
+    # and uploaded on a background thread. on_done(parts, rejected) is called
+    # from that thread. The turn is over by then, the loading is logged as a
+    # request of its own.
+    def start(self, attachments, on_done=lambda parts, rejected: None):
+        def run():
+            metrics.begin("attachments")
+            try:
+                result = self.run(attachments)
+            finally:
+                metrics.end()
+            on_done(*result)
+        threading.Thread(target=run, name="attachments", daemon=True).start()
+        return [PendingPart(attachment) for attachment in attachments if attachment.error is None]
@@ -0,0 +1,120 @@
+# questions that run next to the conversation while the repl stays usable:
+#   & question    asks on a fork of the current history
+#   && question   asks a side question without any history
+# every answer is shown in its own numbered panel once it is complete.
+#
+# merge rules: a background answer never changes the main history by itself.
+# ":merge N" appends its question and answer after the last turn of the main
+# conversation, in the order they are merged, whatever happened there in the
+# meantime. Attachments that were waiting for the next question when a fork
+# started stay in the main conversation as well.
+import asyncio
+import itertools
+import metrics
+
+
+class Job:
+    def __init__(self, number, prompt, gemini, with_history) -> None:
+        self.number = number
+        self.prompt = prompt
+        self.gemini = gemini
+        self.with_history = with_history
+        self.task = None
+        self.received = 0
+        self.model = None
+        self.result = None
+        self.error = None
+        self.merged = False
+        self.finished = False
+
+    @property
+    def done(self):
+        return self.finished or (self.task is not None and self.task.done())
+
+    @property
+    def title(self):
+        prompt = self.prompt if len(self.prompt) <= 50 else self.prompt[:47] + "..."
+        return f"[{self.number}] {'&' if self.with_history else '&&'} {prompt}"
+
+    # the prompt as it was sent, e.g. without an "@pro " prefix
+    @property
+    def user_content(self):
+        for content in reversed(self.gemini.contents):
+            if content.role == "user":
+                return content
+        return None
+
+    def status(self):
+        if not self.done:
+            return f"running, {self.received} chars"
+        if self.error:
+            return f"failed: {self.error}"
+        return f"{self.model}, {'merged' if self.merged else 'done'}"
+
+
+# make_accumulator builds the ResponseAccumulator of the repl, on_done(job) is
+# called on the event loop when a job finished or failed
+class JobManager:
+    def __init__(self, llm, make_accumulator, on_done=lambda job: None) -> None:
+        self.llm = llm
+        self.make_accumulator = make_accumulator
+        self.on_done = on_done
+        self.jobs = {}
+        self._numbers = itertools.count(1)
+
+    @property
+    def running(self):
+        return [job for job in self.jobs.values() if not job.done]
+
+    # must be called from the event loop of the repl
+    def start(self, prompt, with_history=True):
+        job = Job(next(self._numbers), prompt, self.llm.gemini.fork(keep_history=with_history), with_history)
+        job.task = asyncio.ensure_future(self._run(job))
+        self.jobs[job.number] = job
+        return job
+
+    async def _run(self, job):
+        metrics.begin("background")
+        accumulator = self.make_accumulator()
+        try:
+            async for delta in self.llm.ask_llm_async(job.prompt, job.gemini):
+                accumulator.add(delta)
+                job.received += len(delta["text"])
+            if accumulator.model_output:
+                job.result = accumulator.result()
+            else:
+                job.error = "no answer"
+        except asyncio.CancelledError:
+            job.error = "cancelled"
+            raise
+        except Exception as e:
+            job.error = str(e) or type(e).__name__
+        finally:
+            request_metrics = metrics.end()
+            job.model = request_metrics.model if request_metrics else None
+            job.finished = True
+            if job.error != "cancelled":
+                self.on_done(job)
+
+    def get(self, number):
+        if number not in self.jobs:
+            raise ValueError(f"there is no background question {number}")
+        return self.jobs[number]
+
+    # appends the question and answer of a finished job to gemini.contents
+    def merge(self, number, gemini):
+        job = self.get(number)
+        if not job.done:
+            raise ValueError(f"[{number}] is still running")
+        if job.merged:
+            raise ValueError(f"[{number}] is already merged")
+        if not job.result or not job.user_content:
+            raise ValueError(f"[{number}] has no answer to merge")
+        gemini.contents += [job.user_content]
+        gemini.add_content(role="model", text=job.result["model_output"])
+        job.merged = True
+        return job
+
+    def cancel_all(self):
+        for job in self.running:
+            job.task.cancel()
@@ -0,0 +1,156 @@
+################################################################################
+#  batch mode: one request per JSONL line, e.g.                                #
+#  {"prompt": "classify ...", "files": ["a.pdf"], "model": "lite",             #
+#   "instruction": "answer with one word"}                                     #
+#  results are written in completion order as                                  #
+#  {"index": 0, "model": "...", "output": "...", "error": null}                #
+#  a line with a "schema" (a json schema object, a json schema file or         #
+#  module:Model) gets json back, "output" is then the parsed value             #
+################################################################################
+import sys, time
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+import gemini_search, filehandling, response_cache, metrics, structured
+from llm import Llm, ResponseAccumulator
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute) -> None:
+        self.interval = 60 / requests_per_minute if requests_per_minute else 0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        time.sleep(max(0.0, slot - now))
+
+
+class BatchRunner:
+    def __init__(self, workers=8, rpm=60, client=None, default_model=None, cache_responses=False, default_schema=None, hedge_after=None, deadline=None) -> None:
+        self.workers = workers
+        self.hedge_after = hedge_after
+        self.deadline = deadline
+        self.default_schema = default_schema
+        self.response_cache = response_cache.ResponseCache() if cache_responses else None
+        self.default_model = default_model
+        self.rate_limiter = RateLimiter(rpm)
+        self.client = client if client else gemini_search.GeminiSearch().client
+        self.file_loaders = (filehandling.LocalFileLoader, filehandling.UrlFileLoader)
+
+    def read_requests(self, lines):
+        for index, line in enumerate(lines):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield index, {"error": f"invalid json: {e}"}
+                continue
+            if not isinstance(request, dict):
+                yield index, {"error": f"expected a json object, got {type(request).__name__}"}
+                continue
+            yield index, request
+
+    def add_file(self, gemini, file_name):
+        for fl in self.file_loaders:
+            loader = fl()
+            if validated_name := loader.validate(file_name):
+                mimetype = loader.get_mimetype(validated_name)
+                if mimetype not in gemini_search.allowed_mimetypes:
+                    loader.discard(validated_name)
+                    raise ValueError(f"{file_name} has non allowed mimetype {mimetype}")
+                gemini.add_file_to_content(loader.load(validated_name), mimetype)
+                return
+        raise ValueError(f"{file_name} is neither a file nor an url")
+
+    # one failing line never aborts the batch, its error goes into its result
+    def run_one(self, index, request):
+        metrics.begin("batch")
+        try:
+            return self._run_one(index, request)
+        except Exception as e:
+            return {"index": index, "model": None, "output": None, "error": f"{type(e).__name__}: {e}"}
+        finally:
+            metrics.end()
+
+    def _run_one(self, index, request):
+        result = {"index": index, "model": None, "output": None, "error": request.get("error")}
+        if result["error"]:
+            return result
+
+        try:
+            gemini = gemini_search.GeminiSearch(client=self.client)
+            gemini.response_cache = self.response_cache
+            gemini.retry_policy.hedge_after_s = self.hedge_after
+            if self.deadline:
+                gemini.retry_policy.deadline_s = self.deadline
+            llm = Llm(gemini=gemini, keep_parts=False)
+            if model := request.get("model", self.default_model):
+                llm.select_model(model)
+            gemini.system_instruction = request.get("instruction", "")
+            if schema := request.get("schema", self.default_schema):
+                gemini.schema = structured.make(schema)
+            for file_name in request.get("files", []):
+                self.add_file(gemini, file_name)
+
+            self.rate_limiter.acquire()
+            if gemini.schema:
+                result["output"] = self.collect_structured(llm.ask_llm(request["prompt"]), gemini.schema)
+                result["model"] = gemini.model.name
+                return result
+            response = ResponseAccumulator.collect(llm.ask_llm(request["prompt"]))
+            # with auto routing the model is picked for the prompt
+            result["model"] = gemini.model.name
+        except (KeyError, ValueError, filehandling.FileLoadError, gemini_search.UploadError, structured.SchemaError) as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+            return result
+
+        if not response:
+            result["error"] = "no response"
+        else:
+            result["output"] = response["model_output"]
+        return result
+
+    # validates the records while they arrive and stops the answer at the
+    # first one that does not match, the rest would be thrown away anyway
+    def collect_structured(self, deltas, schema):
+        stream = structured.StructuredStream(schema)
+        for delta in deltas:
+            stream.feed(delta["text"])
+            if stream.errors:
+                deltas.close()
+                break
+        return stream.finish()
+
+    def run(self, lines, out):
+        pending = set()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for index, request in self.read_requests(lines):
+                # keep the number of queued requests bounded, so a huge input is streamed
+                if len(pending) >= 2 * self.workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    self._write(done, out)
+                pending.add(executor.submit(self.run_one, index, request))
+            self._write(as_completed(pending), out)
+
+    def _write(self, futures, out):
+        for future in futures:
+            out.write(json.dumps(future.result(), ensure_ascii=False) + "\n")
+            out.flush()
+
+    def run_files(self, input_name, output_name):
+        in_file = sys.stdin if input_name == "-" else open(input_name)
+        out_file = sys.stdout if output_name == "-" else open(output_name, "w")
+        try:
+            self.run(in_file, out_file)
+        finally:
+            if in_file is not sys.stdin:
+                in_file.close()
+            if out_file is not sys.stdout:
+                out_file.close()
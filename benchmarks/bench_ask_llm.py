@@ -0,0 +1,108 @@
+# replays synthetic chunks through Llm.ask_llm and compares the delta based
+# accumulation with the previous "model_output += chunk.text" implementation
+#
+#   python benchmarks/bench_ask_llm.py [num_chunks] [chunk_size]
+import os, sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from google.genai import types
+from llm import Llm, ResponseAccumulator
+import models
+
+
+# Llm.routing swaps the model for "@pro" prefixes, so a model is needed as well
+class FakeGemini:
+    def __init__(self, chunks) -> None:
+        self.chunks = chunks
+        self.tools_state = {"url_context": True, "google_search": True}
+        self.known_models = (models.GEMINI_2_5_PRO, models.GEMINI_2_5_FLASH, models.GEMINI_2_5_FLASH_LITE)
+        self.model = models.GEMINI_2_5_FLASH()
+
+    def find_model(self, name):
+        return next(model_class() for model_class in self.known_models if model_class().short_name == name)
+
+    def generate_stream(self, user_prompt):
+        yield from self.chunks
+
+
+def make_chunks(num_chunks, chunk_size):
+    chunks = []
+    for i in range(num_chunks):
+        text = (f"{i:08d} " + "x" * chunk_size)[:chunk_size]
+        chunks.append(types.GenerateContentResponse(candidates=[
+            types.Candidate(content=types.Content(role="model", parts=[types.Part.from_text(text=text)]))
+            ]))
+    return chunks
+
+
+def legacy_ask_llm(gemini, prompt):
+    model_output = ""
+    grounding_chunks = []
+    url_metadata = []
+    parts = []
+    for chunk in gemini.generate_stream(prompt):
+        if type(chunk.text)==str:
+            model_output += chunk.text
+
+        if gemini.tools_state['google_search']:
+            if chunk.candidates and chunk.candidates[0].grounding_metadata and chunk.candidates[0].grounding_metadata.grounding_chunks:
+                grounding_chunks += chunk.candidates[0].grounding_metadata.grounding_chunks
+
+        if gemini.tools_state['url_context']:
+            if chunk.candidates and chunk.candidates[0].url_context_metadata and chunk.candidates[0].url_context_metadata.url_metadata:
+                url_metadata += chunk.candidates[0].url_context_metadata.url_metadata
+
+        if chunk.candidates:
+            for candidate in chunk.candidates:
+                if candidate.content.parts:
+                    for part in candidate.content.parts:
+                        parts.append(part)
+
+        yield {
+            "model_output":model_output,
+            "grounding_chunks":grounding_chunks,
+            "url_metadata":url_metadata,
+            "parts":parts,
+            }
+
+
+def run_legacy(gemini):
+    # consumes every yield of the growing output, like RichPrinter did
+    result = {}
+    for result in legacy_ask_llm(gemini, "prompt"):
+        pass
+    return result["model_output"]
+
+
+def run_delta(gemini, keep_parts):
+    llm = Llm(gemini=gemini, keep_parts=keep_parts)
+    return ResponseAccumulator.collect(llm.ask_llm("prompt"))["model_output"]
+
+
+def measure(name, func):
+    tracemalloc.start()
+    start = time.perf_counter()
+    output = func()
+    duration = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<24} {duration * 1000:10.1f} ms   peak {peak / 1e6:8.1f} MB   {len(output)} chars")
+    return output
+
+
+def main(argv):
+    num_chunks = int(argv[1]) if len(argv) > 1 else 10_000
+    chunk_size = int(argv[2]) if len(argv) > 2 else 200
+    gemini = FakeGemini(make_chunks(num_chunks, chunk_size))
+    print(f"{num_chunks} chunks of {chunk_size} chars")
+
+    legacy = measure("legacy accumulation", lambda: run_legacy(gemini))
+    delta = measure("delta, keep parts", lambda: run_delta(gemini, keep_parts=True))
+    lean = measure("delta, drop parts", lambda: run_delta(gemini, keep_parts=False))
+    assert legacy == delta == lean
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,207 @@
+# offline benchmark of the answer pipeline against the local fake Gemini server
+# in fake_gemini.py, reports wall time per run and the tracemalloc peak
+#
+#   python benchmarks/bench_pipeline.py [--chunks 200] [--chunk-size 40] [--chunk-delay 0]
+#       [--first-chunk-delay 0] [--no-grounding] [--error-rate 0] [--runs 5] [--batch 64]
+#       [--file-mb 256] [--only ask_llm render_stream ...] [--base-url http://127.0.0.1:8766]
+#
+# attach_file uploads a --file-mb video streamed from disk, attach_file_read
+# the same file read into memory first. The peak of the first should stay at a
+# few upload chunks for any --file-mb.
+#
+# the in-process server competes with the client for the GIL, with --base-url
+# a server started by "python benchmarks/fake_gemini.py" is used instead
+import os, sys
+import io
+import atexit
+import shutil
+import time
+import argparse
+import tempfile
+import contextlib
+import tracemalloc
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from rich.console import Console
+import fake_gemini
+import gemini_search, filehandling, blobstore, attachments
+import repl3
+from llm import Llm, ResponseAccumulator
+from render import RichPrinter, StructuredOutput
+from json_records import JsonExtractor, StreamingJsonExtractor
+import batch, structured
+
+
+def make_llm(client):
+    return Llm(gemini=gemini_search.GeminiSearch(client=client))
+
+
+def make_printer(stream):
+    printer = RichPrinter(stream=stream, refresh_per_second=8)
+    printer.console = Console(file=io.StringIO(), force_terminal=True, width=100)
+    return printer
+
+
+def bench_ask_llm(client, args):
+    llm = make_llm(client)
+    def run():
+        llm.clear_history()
+        ResponseAccumulator.collect(llm.ask_llm("benchmark"))
+    return run
+
+
+def bench_json_extractor(client, args):
+    text = ResponseAccumulator.collect(make_llm(client).ask_llm("benchmark"))["model_output"]
+    return lambda: JsonExtractor().extract(text)
+
+
+# the same answer as recorded deltas, records are taken out while they arrive
+def bench_json_stream(client, args):
+    deltas = list(make_llm(client).ask_llm("benchmark"))
+    return lambda: list(StreamingJsonExtractor.records(iter(deltas)))
+
+
+def bench_render(stream):
+    def setup(client, args):
+        # replays recorded deltas so only the rendering is measured
+        deltas = list(make_llm(client).ask_llm("benchmark"))
+        def run():
+            make_printer(stream).render(iter(deltas))
+        return run
+    return setup
+
+
+# the same replay for a json answer that follows a schema, records are
+# validated and printed as json lines instead of rendered as markdown
+def bench_render_structured(client, args):
+    llm = make_llm(client)
+    llm.gemini.schema = structured.from_json_schema({"type": "array", "items": {"type": "object", "required": ["id", "name"],
+        "properties": {"id": {"type": "integer"}, "name": {"type": "string"}, "score": {"type": "number"}}}})
+    deltas = list(llm.ask_llm("benchmark"))
+    def run():
+        printer = make_printer(stream=True)
+        printer.render(iter(deltas), StructuredOutput(printer, llm.gemini.schema))
+    return run
+
+
+def bench_handler_chain(client, args):
+    llm = make_llm(client)
+    view = SimpleNamespace(printer=make_printer(stream=True))
+    file_cache = blobstore.BlobStore()
+    h_llm = repl3.DefaultHandler(llm, view)
+    h_files = repl3.FileHandler(llm, view,
+                                lambda: filehandling.CachingFileLoader(filehandling.LocalFileLoader(), file_cache),
+                                lambda: filehandling.CachingFileLoader(filehandling.UrlFileLoader(), file_cache), successor=h_llm)
+    h_youtube_url = repl3.YoutubeUrlHandler(llm, view, h_files)
+    h_instruction = repl3.SystemInstructionHandler(llm, view, h_youtube_url)
+    h_session = repl3.SessionHandler(llm, view, h_instruction)
+    h_empty = repl3.EmptyPromptHandler(h_session)
+    h_exit = repl3.ExitHandler(h_empty)
+    def run():
+        llm.clear_history()
+        with contextlib.redirect_stdout(io.StringIO()):
+            h_exit.handle("benchmark")
+    return run
+
+
+def bench_attach_file(stream_from_disk):
+    def setup(client, args):
+        directory = tempfile.mkdtemp(prefix="bench-attach-")
+        atexit.register(shutil.rmtree, directory, True)
+        path = f"{directory}/video.mp4"
+        with open(path, "wb") as f:
+            f.truncate(args.file_mb * 1024 * 1024)
+        gemini = gemini_search.GeminiSearch(client=client)
+        loader = attachments.AttachmentLoader(gemini, gemini_search.allowed_mimetypes, stream_from_disk=stream_from_disk)
+        def run():
+            # a fresh upload cache, otherwise only the first run uploads
+            if os.path.exists(f"{directory}/uploads.json"):
+                os.remove(f"{directory}/uploads.json")
+            gemini.upload_cache = gemini_search.UploadCache(f"{directory}/uploads.json")
+            parts, rejected = loader.run([attachments.Attachment(path, filehandling.LocalFileLoader)])
+            assert parts and parts[0].file_data and not rejected
+        return run
+    return setup
+
+
+def bench_batch(client, args):
+    lines = [f'{{"prompt": "benchmark {i}"}}\n' for i in range(args.batch)]
+    runner = batch.BatchRunner(workers=args.workers, rpm=0, client=client)
+    return lambda: runner.run(lines, io.StringIO())
+
+
+benchmarks = {
+    "ask_llm": bench_ask_llm,
+    "json_extractor": bench_json_extractor,
+    "json_stream": bench_json_stream,
+    "render_stream": bench_render(stream=True),
+    "render_progress": bench_render(stream=False),
+    "render_structured": bench_render_structured,
+    "handler_chain": bench_handler_chain,
+    "batch": bench_batch,
+    "attach_file": bench_attach_file(stream_from_disk=True),
+    "attach_file_read": bench_attach_file(stream_from_disk=False),
+}
+
+
+def measure(run, runs):
+    run()
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), sum(times) / len(times), peak
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="offline pipeline benchmark")
+    parser.add_argument("--chunks", type=int, default=200, help="chunks per streamed answer")
+    parser.add_argument("--chunk-size", type=int, default=40, help="characters per chunk")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="seconds between chunks")
+    parser.add_argument("--first-chunk-delay", type=float, default=0.0, help="seconds before the first chunk")
+    parser.add_argument("--no-grounding", action="store_true", help="do not send grounding metadata")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with an error")
+    parser.add_argument("--error-status", type=int, default=503, help="http status of the simulated errors")
+    parser.add_argument("--runs", type=int, default=5, help="timed runs per benchmark")
+    parser.add_argument("--batch", type=int, default=64, help="requests per batch run")
+    parser.add_argument("--workers", type=int, default=8, help="batch workers")
+    parser.add_argument("--file-mb", type=int, default=256, help="size of the attached file")
+    parser.add_argument("--base-url", help="use an already running fake server, the server options are ignored")
+    parser.add_argument("--only", nargs="+", choices=list(benchmarks), help="run only these benchmarks")
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    server = None
+    if args.base_url:
+        base_url = args.base_url
+    else:
+        server = fake_gemini.FakeGeminiServer(chunk_size=args.chunk_size, num_chunks=args.chunks,
+                                              first_chunk_delay=args.first_chunk_delay, chunk_delay=args.chunk_delay,
+                                              grounding=not args.no_grounding, error_status=args.error_status,
+                                              error_rate=args.error_rate).start()
+        base_url = server.base_url
+    client = fake_gemini.make_client(base_url)
+    print(f"{args.chunks} chunks of {args.chunk_size} chars, {args.runs} runs, server at {base_url}")
+    print(f"{'benchmark':<18}{'min s':>10}{'mean s':>10}{'peak MB':>10}")
+    try:
+        for name in args.only or benchmarks:
+            # simulated errors are reported, keep them out of the table
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                best, mean, peak = measure(benchmarks[name](client, args), args.runs)
+            print(f"{name:<18}{best:>10.4f}{mean:>10.4f}{peak / 2**20:>10.2f}")
+    finally:
+        if server:
+            server.stop()
+
+
+if __name__ == "__main__":
+    main()
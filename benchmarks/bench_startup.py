@@ -0,0 +1,95 @@
+# measures the repl startup: import time of repl3 (from -X importtime) and the
+# time until the prompt could be shown and until gemini is ready for the first
+# question. Compare against a saved baseline to catch regressions:
+#
+#   python benchmarks/bench_startup.py --save startup.json
+#   python benchmarks/bench_startup.py --baseline startup.json
+import os, sys
+import argparse
+import json
+import subprocess
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+startup_script = """
+import os, time
+os.environ.setdefault("GEMINI_API_KEY", "benchmark")
+start = time.perf_counter()
+import repl3
+imported = time.perf_counter()
+controller = repl3.ReplController()
+prompt_ready = time.perf_counter()
+controller.llm.gemini
+gemini_ready = time.perf_counter()
+print(json.dumps({"import_ms": (imported - start) * 1000, "prompt_ms": (prompt_ready - start) * 1000, "gemini_ms": (gemini_ready - start) * 1000}))
+"""
+
+
+def run_python(args):
+    return subprocess.run([sys.executable, *args], cwd=repo_dir, capture_output=True, text=True, stdin=subprocess.DEVNULL)
+
+
+def parse_importtime(stderr):
+    # lines look like "import time:       339 |     657425 | google.genai",
+    # nested imports are indented by two more spaces per level
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        modules.append((int(cumulative_us), name.rstrip()[1:]))
+    return modules
+
+
+def measure(runs):
+    importtime = run_python(["-X", "importtime", "-c", "import repl3"])
+    modules = parse_importtime(importtime.stderr)
+    # modules imported directly by repl3
+    direct = [module for module in modules if module[1].startswith("  ") and not module[1].startswith("    ")]
+
+    timings = []
+    for _ in range(runs):
+        result = run_python(["-c", "import json\n" + startup_script])
+        if result.returncode:
+            sys.exit(result.stderr)
+        timings.append(json.loads(result.stdout.splitlines()[-1]))
+
+    report = {key: min(timing[key] for timing in timings) for key in timings[0]}
+    report["import_repl3_ms"] = next(cumulative for cumulative, name in modules if name == "repl3") / 1000
+    report["top_imports"] = [(name.strip(), cumulative / 1000) for cumulative, name in sorted(direct, reverse=True)[:10]]
+    return report
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="repl startup benchmark")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--save", metavar="JSON", help="store the result as baseline")
+    parser.add_argument("--baseline", metavar="JSON", help="fail if slower than this baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    args = parser.parse_args(argv[1:])
+
+    report = measure(args.runs)
+    print(f"import repl3 (importtime)  {report['import_repl3_ms']:8.1f} ms")
+    print(f"import repl3               {report['import_ms']:8.1f} ms")
+    print(f"prompt ready               {report['prompt_ms']:8.1f} ms")
+    print(f"gemini ready               {report['gemini_ms']:8.1f} ms")
+    print("slowest imports of repl3:")
+    for name, cumulative_ms in report["top_imports"]:
+        print(f"  {name:<30} {cumulative_ms:8.1f} ms")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = [key for key in ("import_ms", "prompt_ms") if report[key] > baseline[key] * (1 + args.tolerance)]
+        for key in regressions:
+            print(f"regression: {key} {report[key]:.1f} ms, baseline {baseline[key]:.1f} ms")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,234 @@
+# local stand-in for the Gemini REST endpoints used by this project, so the
+# whole pipeline can be measured without quota or network jitter.
+#
+#   server = FakeGeminiServer(chunk_size=40, num_chunks=200, chunk_delay=0.001)
+#   server.start()
+#   client = server.make_client()    # a genai.Client talking to the fake server
+#
+# or standalone, to keep the server out of the measured process:
+#
+#   python benchmarks/fake_gemini.py --port 8766 --chunk-delay 0.01
+#
+# streamGenerateContent answers with server-sent events like the real API,
+# generateContent with a single response. Errors are returned with the status
+# and body of the real API, including a RetryInfo detail. A request for json
+# is answered with a bare json array. Resumable uploads of the Files API are
+# accepted and counted, the uploaded bytes are dropped.
+import sys
+import json
+import argparse
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+error_statuses = {429: "RESOURCE_EXHAUSTED", 500: "INTERNAL", 503: "UNAVAILABLE"}
+
+
+def make_answer_text(num_chars, num_records=20):
+    records = [{"id": i, "name": f"record {i}", "score": round(i * 0.37, 2)} for i in range(num_records)]
+    json_block = "```json\n" + json.dumps(records, indent=2) + "\n```\n\n"
+    paragraph = ("Lorem ipsum dolor sit amet, **consectetur** adipiscing elit, sed do eiusmod tempor "
+                 "incididunt ut labore et dolore magna aliqua. `code` and [a link](https://example.com).\n\n")
+    text = "# Answer\n\n" + json_block
+    while len(text) < num_chars:
+        text += paragraph
+    return text[:num_chars]
+
+
+# the answer to a request for json, a bare array of records
+def make_json_text(num_chars):
+    records, size = [], 2
+    while size < num_chars:
+        records.append({"id": len(records), "name": f"record {len(records)}", "score": round(len(records) * 0.37, 2)})
+        size += len(json.dumps(records[-1])) + 2
+    return json.dumps(records)
+
+
+def make_client(base_url):
+    from google import genai
+    from google.genai import types
+    return genai.Client(api_key="fake", http_options=types.HttpOptions(base_url=base_url))
+
+
+class FakeGeminiServer:
+    def __init__(self, chunk_size=40, num_chunks=200, first_chunk_delay=0.0, chunk_delay=0.0,
+                 grounding=True, error_status=503, error_rate=0.0, fail_first=0, seed=0) -> None:
+        self.chunk_size = chunk_size
+        self.num_chunks = num_chunks
+        self.first_chunk_delay = first_chunk_delay
+        self.chunk_delay = chunk_delay
+        self.grounding = grounding
+        self.error_status = error_status
+        self.error_rate = error_rate
+        self.fail_first = fail_first
+        self.random = random.Random(seed)
+        self.num_requests = 0
+        self.uploaded_bytes = 0
+        self._uploads = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self, port=0):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                fake.handle(self, body)
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def make_client(self):
+        return make_client(self.base_url)
+
+    def should_fail(self):
+        with self._lock:
+            self.num_requests += 1
+            if self.num_requests <= self.fail_first:
+                return True
+            return self.random.random() < self.error_rate
+
+    def make_chunk(self, model, text, last):
+        chunk = {
+            "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}],
+            "modelVersion": model,
+        }
+        if last:
+            chunk["candidates"][0]["finishReason"] = "STOP"
+            chunk["usageMetadata"] = {"promptTokenCount": 1000, "candidatesTokenCount": self.chunk_size * self.num_chunks // 4,
+                                      "totalTokenCount": 1000 + self.chunk_size * self.num_chunks // 4}
+            if self.grounding:
+                chunk["candidates"][0]["groundingMetadata"] = {"groundingChunks": [
+                    {"web": {"uri": f"https://example.com/{i}", "title": f"source {i}"}} for i in range(3)]}
+        return chunk
+
+    def send_error(self, handler):
+        status = self.error_status
+        body = json.dumps({"error": {"code": status, "message": "fake error", "status": error_statuses.get(status, "UNKNOWN"),
+                                     "details": [{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": "1s"}]}}).encode()
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(body)))
+        handler.send_header("Retry-After", "1")
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def send_json(self, handler, data, headers={}):
+        data = json.dumps(data).encode()
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    # the start request returns the upload url, the chunks are posted to it
+    def handle_upload(self, handler, body):
+        if not (match := re.search(r"upload_id=(\d+)", handler.path)):
+            with self._lock:
+                upload_id = str(len(self._uploads))
+                self._uploads[upload_id] = json.loads(body or b"{}").get("file", {})
+            self.send_json(handler, {}, {"x-goog-upload-url": f"{self.base_url}/upload/v1beta/files?upload_id={upload_id}",
+                                         "x-goog-upload-status": "active"})
+            return
+        upload_id = match.group(1)
+        with self._lock:
+            self.uploaded_bytes += len(body)
+        if "finalize" not in handler.headers.get("X-Goog-Upload-Command", ""):
+            self.send_json(handler, {}, {"x-goog-upload-status": "active"})
+            return
+        file = dict(self._uploads[upload_id], name=f"files/fake-{upload_id}", uri=f"{self.base_url}/v1beta/files/fake-{upload_id}", state="ACTIVE")
+        self.send_json(handler, {"file": file}, {"x-goog-upload-status": "final"})
+
+    def handle(self, handler, body):
+        if handler.path.startswith("/upload/"):
+            self.handle_upload(handler, body)
+            return
+        match = re.search(r"/models/([^:/]+):(streamGenerateContent|generateContent)", handler.path)
+        if not match:
+            handler.send_response(404)
+            handler.send_header("Content-Length", "0")
+            handler.end_headers()
+            return
+        if self.should_fail():
+            self.send_error(handler)
+            return
+
+        model, method = match.groups()
+        config = json.loads(body or b"{}").get("generationConfig", {})
+        if config.get("responseMimeType") == "application/json":
+            text = make_json_text(self.chunk_size * self.num_chunks)
+        else:
+            text = make_answer_text(self.chunk_size * self.num_chunks)
+        time.sleep(self.first_chunk_delay)
+        if method == "generateContent":
+            data = json.dumps(self.make_chunk(model, text, last=True)).encode()
+            handler.send_response(200)
+            handler.send_header("Content-Type", "application/json")
+            handler.send_header("Content-Length", str(len(data)))
+            handler.end_headers()
+            handler.wfile.write(data)
+            return
+
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+        pieces = [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)]
+        try:
+            for index, piece in enumerate(pieces):
+                if index:
+                    time.sleep(self.chunk_delay)
+                event = f"data: {json.dumps(self.make_chunk(model, piece, last=index == len(pieces) - 1))}\r\n\r\n".encode()
+                handler.wfile.write(f"{len(event):x}\r\n".encode() + event + b"\r\n")
+                handler.wfile.flush()
+            handler.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # the client stopped reading the answer
+            handler.close_connection = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="fake Gemini streaming server")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--chunks", type=int, default=200, help="chunks per streamed answer")
+    parser.add_argument("--chunk-size", type=int, default=40, help="characters per chunk")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="seconds between chunks")
+    parser.add_argument("--first-chunk-delay", type=float, default=0.0, help="seconds before the first chunk")
+    parser.add_argument("--no-grounding", action="store_true", help="do not send grounding metadata")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with an error")
+    parser.add_argument("--error-status", type=int, default=503, help="http status of the simulated errors")
+    args = parser.parse_args(sys.argv[1:])
+    server = FakeGeminiServer(chunk_size=args.chunk_size, num_chunks=args.chunks, first_chunk_delay=args.first_chunk_delay,
+                              chunk_delay=args.chunk_delay, grounding=not args.no_grounding,
+                              error_status=args.error_status, error_rate=args.error_rate).start(args.port)
+    print(f"serving on {server.base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import os
+import shutil
+import threading
+import contextlib
+import hashlib, json, tempfile
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# content addressed store for payloads on disk. Blobs live under their sha256,
+# keys map to a blob plus some metadata. The least recently used blobs are
+# evicted once the store grows beyond max_size_mb. The repl, batch runs and
+# the daemon share the store: a read only touches the blob, a write merges
+# into the index on disk under a file lock.
+class BlobStore:
+    def __init__(self, directory=None, max_size_mb=1024) -> None:
+        self.directory = directory if directory else f"{tempfile.gettempdir()}/.llm-cache"
+        self.max_size = max_size_mb * 1024 * 1024
+        self._index = None
+        self._index_stamp = None
+        self._scanned = False
+        # attachments are loaded on several threads at once
+        self._lock = threading.RLock()
+
+    @property
+    def index_path(self):
+        return f"{self.directory}/index.json"
+
+    # read again when another process replaced the file
+    @property
+    def index(self):
+        stamp = self._stamp()
+        if self._index is None or stamp != self._index_stamp:
+            try:
+                with open(self.index_path) as f:
+                    self._index = json.load(f)
+            except (OSError, ValueError):
+                self._index = {"keys": {}, "blobs": {}}
+            self._index_stamp = stamp
+        return self._index
+
+    def _stamp(self):
+        try:
+            stat = os.stat(self.index_path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def blob_path(self, digest):
+        return f"{self.directory}/blobs/{digest[:2]}/{digest}"
+
+    def lookup(self, key):
+        with self._lock:
+            entry = self.index["keys"].get(key)
+            if entry and entry["digest"] in self.index["blobs"]:
+                return entry
+            return None
+
+    # the modification time of a blob is its last use
+    def get(self, key):
+        if not (entry := self.lookup(key)):
+            return None
+        path = self.blob_path(entry["digest"])
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    # without a key the blob is stored under "sha256:<digest>"
+    def put(self, key, data, **metadata):
+        digest = hashlib.sha256(data).hexdigest()
+        key = key if key else f"sha256:{digest}"
+        if len(data) > self.max_size:
+            return digest
+
+        path = self.blob_path(digest)
+        if not self._touch(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        self._add(key, digest, len(data), metadata)
+        return digest
+
+    # stores a copy of a file without reading it into memory
+    def put_file(self, source, digest, key=None, **metadata):
+        key = key if key else f"sha256:{digest}"
+        path = self.blob_path(digest)
+        if not self._touch(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            shutil.copyfile(source, tmp_path)
+            os.replace(tmp_path, path)
+        self._add(key, digest, os.path.getsize(path), metadata)
+        return digest
+
+    @staticmethod
+    def _touch(path):
+        try:
+            os.utime(path)
+            return True
+        except OSError:
+            return False
+
+    # merges the entry into the index as it is on disk right now
+    def _add(self, key, digest, size, metadata):
+        with self._lock, self._file_lock():
+            index = self.index
+            index["blobs"][digest] = {"size": size}
+            index["keys"][key] = {"digest": digest, **metadata}
+            self._evict(index)
+            self._save_index(index)
+
+    # serializes the writers of all processes, the lock is released on close
+    @contextlib.contextmanager
+    def _file_lock(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(f"{self.directory}/index.lock", "a") as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    # sizes and last uses are taken from the blob files, that also counts
+    # blobs a crashed process left without an index entry. The blob directory
+    # is scanned on the first write of a process and when the index says the
+    # store is full.
+    def _evict(self, index):
+        if self._scanned and sum(blob["size"] for blob in index["blobs"].values()) <= self.max_size:
+            return
+        self._scanned = True
+        found = {}
+        with contextlib.suppress(OSError), os.scandir(f"{self.directory}/blobs") as folders:
+            for folder in folders:
+                with contextlib.suppress(OSError), os.scandir(folder.path) as blobs:
+                    for blob in blobs:
+                        if not blob.name.endswith(".tmp"):
+                            with contextlib.suppress(OSError):
+                                stat = blob.stat()
+                                found[blob.name] = (stat.st_mtime, stat.st_size)
+
+        total = sum(size for _, size in found.values())
+        for digest in sorted(found, key=lambda digest: found[digest][0]):
+            if total <= self.max_size:
+                break
+            total -= found.pop(digest)[1]
+            with contextlib.suppress(OSError):
+                os.remove(self.blob_path(digest))
+        index["blobs"] = {digest: {"size": size} for digest, (_, size) in found.items()}
+        index["keys"] = {key: entry for key, entry in index["keys"].items() if entry["digest"] in index["blobs"]}
+
+    def _save_index(self, index):
+        tmp_path = f"{self.index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+        self._index_stamp = self._stamp()
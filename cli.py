@@ -0,0 +1,40 @@
+################################################################################
+#  command line of repl3.py. A one-shot prompt is forwarded to a running       #
+#  daemon from here, before repl3 imports prompt_toolkit, rich and the rest.   #
+#  Only the standard library is imported.                                      #
+################################################################################
+import argparse
+import daemon
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Command Line LLM")
+    # everything from the first word of the prompt on belongs to it, dashes included
+    parser.add_argument("prompt", nargs=argparse.REMAINDER, help="answer this prompt and exit instead of starting the repl, options go before it")
+    parser.add_argument("--batch", metavar="JSONL", help="run the prompts of a JSONL file concurrently, - reads stdin")
+    parser.add_argument("--output", "-o", metavar="JSONL", default="-", help="where batch results are written, default stdout")
+    parser.add_argument("--workers", type=int, default=8, help="concurrent batch requests")
+    parser.add_argument("--rpm", type=float, default=60, help="batch requests per minute, 0 for no limit")
+    parser.add_argument("--model", help="pro, flash, lite or auto")
+    parser.add_argument("--serve", action="store_true", help="run a warm background server that answers one-shot prompts")
+    parser.add_argument("--no-daemon", action="store_true", help="answer one-shot prompts in process even if a server runs")
+    parser.add_argument("--cache-responses", action="store_true", help="replay identical requests from an on-disk response cache")
+    parser.add_argument("--no-preprocess", action="store_true", help="send images and audio as they are instead of shrinking them first")
+    parser.add_argument("--schema", metavar="SPEC", help="answer with json that follows a json schema file or a pydantic model module:Model (module:Model[] for a list)")
+    parser.add_argument("--json-out", metavar="JSONL", help="append the records of ```json blocks in the answers to this file while they stream, - for stdout")
+    parser.add_argument("--profile", action="store_true", help="write a cProfile dump of every turn to the temp dir")
+    parser.add_argument("--resume", metavar="SESSION", help="continue a session saved with :save")
+    parser.add_argument("--hedge", type=float, metavar="SECONDS", help="ask flash as well if pro has not started to answer after this")
+    parser.add_argument("--deadline", type=float, metavar="SECONDS", help="give up on a turn that has not started to answer after this, retries included, default 120")
+    parser.add_argument("--context-budget", type=int, default=200_000, metavar="TOKENS", help="summarize old turns when the history grows beyond this")
+    args = parser.parse_args(args)
+    if args.prompt[:1] == ["--"]:
+        args.prompt = args.prompt[1:]
+    return args
+
+
+# the daemon answers with its own settings, a prompt that needs others is
+# answered in process. True if the daemon answered.
+def forward(args):
+    own_settings = args.no_daemon or args.json_out or args.schema or args.resume or args.cache_responses or args.profile or args.hedge is not None or args.deadline is not None
+    return bool(args.prompt) and not args.serve and not args.batch and not own_settings and daemon.ask(" ".join(args.prompt), args.model)
@@ -0,0 +1,99 @@
+# sends one prompt with the current history to several models at once, to see
+# which tier is good enough for a kind of question without asking three times.
+# Every model answers on its own fork of the conversation, ":pick <model>"
+# commits one of the answers to the main history and drops the others.
+import asyncio
+import metrics
+
+
+class Candidate:
+    def __init__(self, model_name, gemini) -> None:
+        self.model_name = model_name
+        self.gemini = gemini
+        self.accumulator = None
+        self.metrics = None
+        self.result = None
+        self.error = None
+        self.done = False
+
+    @property
+    def text(self):
+        return self.accumulator.model_output if self.accumulator else ""
+
+    # the prompt as it was sent, with the attachments it carried
+    @property
+    def user_content(self):
+        for content in reversed(self.gemini.contents):
+            if content.role == "user":
+                return content
+        return None
+
+    def stats(self):
+        request_metrics = self.metrics
+        if request_metrics is None:
+            return "waiting"
+        parts = []
+        if request_metrics.ttft_s is not None:
+            parts.append(f"ttft {request_metrics.ttft_s:.2f}s")
+        if request_metrics.total_s is not None:
+            parts.append(f"total {request_metrics.total_s:.2f}s")
+        if request_metrics.usage:
+            parts.append(f"in {request_metrics.usage['input_tokens']} out {request_metrics.usage['output_tokens']} think {request_metrics.usage['thinking_tokens']}")
+        if self.error:
+            parts.append(f"failed: {self.error}")
+        return "  ".join(parts) or "waiting"
+
+
+# make_accumulator builds the ResponseAccumulator of the repl
+class Comparison:
+    def __init__(self, llm, prompt, model_names, make_accumulator) -> None:
+        self.llm = llm
+        self.prompt = prompt
+        self.make_accumulator = make_accumulator
+        self.picked = None
+        self.candidates = []
+        for model_name in model_names:
+            gemini = llm.gemini.fork()
+            gemini.model = gemini.find_model(model_name)
+            self.candidates.append(Candidate(model_name, gemini))
+
+    async def run(self):
+        await asyncio.gather(*(self._run(candidate) for candidate in self.candidates))
+
+    async def _run(self, candidate):
+        candidate.metrics = metrics.begin("compare")
+        candidate.accumulator = self.make_accumulator()
+        try:
+            async for chunk in candidate.gemini.agenerate_stream(self.prompt):
+                candidate.accumulator.add(self.llm.make_delta(chunk))
+            if candidate.text:
+                candidate.result = candidate.accumulator.result()
+            else:
+                candidate.error = "no answer"
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            candidate.error = str(e) or type(e).__name__
+        finally:
+            metrics.end()
+            candidate.done = True
+
+    def find(self, key):
+        for index, candidate in enumerate(self.candidates):
+            if key in (candidate.model_name, str(index + 1)):
+                return candidate
+        raise ValueError(f"no answer of {key}, choose one of {', '.join(candidate.model_name for candidate in self.candidates)}")
+
+    # appends the prompt and the chosen answer to gemini.contents. Attachments
+    # that waited for this prompt are part of it, they are resolved first.
+    def pick(self, key, gemini):
+        if self.picked:
+            raise ValueError(f"the answer of {self.picked.model_name} was already picked")
+        candidate = self.find(key)
+        if not candidate.result:
+            raise ValueError(f"{candidate.model_name} has no answer to pick")
+        gemini.resolve_deferred()
+        gemini.contents += [candidate.user_content]
+        gemini.add_content(role="model", text=candidate.result["model_output"])
+        self.picked = candidate
+        return candidate
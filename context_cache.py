@@ -0,0 +1,104 @@
+################################################################################
+#        https://ai.google.dev/gemini-api/docs/caching                         #
+################################################################################
+import time
+import threading
+import httpx
+from google.genai import types
+from google.genai.errors import APIError, ClientError
+
+
+# Moves the stable prefix of a conversation (system instruction, tools and all
+# contents before the new prompt) into a Gemini cached content object once the
+# prompt has grown beyond min_tokens. Requests then only send the suffix.
+class ContextCache:
+    def __init__(self, min_tokens=32768, ttl_seconds=600) -> None:
+        self.min_tokens = min_tokens
+        self.ttl_seconds = ttl_seconds
+        self.enabled = True
+        # prompt size of the last request, taken from its usage_metadata
+        self.prompt_tokens = 0
+        self.cached = None
+        self._cached_contents = []
+        self._key = None
+        self._failed_key = None
+
+    @property
+    def cached_tokens(self):
+        if self.cached and self.cached.usage_metadata:
+            return self.cached.usage_metadata.total_token_count or 0
+        return 0
+
+    def observe(self, usage_metadata):
+        if usage_metadata and usage_metadata.prompt_token_count:
+            self.prompt_tokens = usage_metadata.prompt_token_count
+
+    # the cached content is deleted in the background, invalidate is called
+    # from key bindings. One that is not deleted expires after ttl_seconds.
+    def invalidate(self, client):
+        if self.cached:
+            threading.Thread(target=self._delete, args=(client, self.cached.name), daemon=True).start()
+        self.cached = None
+        self._cached_contents = []
+        self._key = None
+
+    # contents[-1] is the new user prompt, returns the contents to send and the
+    # name of the cached content they continue, or None
+    def apply(self, client, model, system_instruction, tool_list, contents):
+        key = (model.name, model.thinking_budget, system_instruction, repr(tool_list))
+        prefix = contents[:-1]
+
+        if self.cached and (key != self._key or not self._still_prefix(prefix) or self._expiring()):
+            if not self._extend(client, key, prefix):
+                self.invalidate(client)
+
+        uncached_tokens = self.prompt_tokens - self.cached_tokens
+        if self.enabled and prefix and uncached_tokens >= self.min_tokens and key != self._failed_key:
+            self.invalidate(client)
+            self._create(client, key, model, system_instruction, tool_list, prefix)
+
+        if self.cached:
+            return contents[len(self._cached_contents):], self.cached.name
+        return contents, None
+
+    @staticmethod
+    def _delete(client, name):
+        try:
+            client.caches.delete(name=name)
+        except (APIError, httpx.TransportError):
+            pass
+
+    def _still_prefix(self, prefix):
+        cached = self._cached_contents
+        return len(prefix) >= len(cached) and all(a is b for a, b in zip(prefix, cached))
+
+    def _expiring(self):
+        expire_time = self.cached.expire_time
+        return expire_time is None or expire_time.timestamp() - time.time() < 60
+
+    def _extend(self, client, key, prefix):
+        if key != self._key or not self._still_prefix(prefix):
+            return False
+        try:
+            self.cached = client.caches.update(name=self.cached.name, config=types.UpdateCachedContentConfig(ttl=f"{self.ttl_seconds}s"))
+        except (APIError, httpx.TransportError):
+            return False
+        return True
+
+    def _create(self, client, key, model, system_instruction, tool_list, prefix):
+        try:
+            self.cached = client.caches.create(model=model.name, config=types.CreateCachedContentConfig(
+                contents=prefix,
+                system_instruction=system_instruction or None,
+                tools=tool_list or None,
+                ttl=f"{self.ttl_seconds}s",
+            ))
+        except ClientError:
+            # e.g. the prefix is below the minimum size of the model, do not retry every turn
+            self._failed_key = key
+            return
+        except (APIError, httpx.TransportError):
+            # the request is sent without a cache, the next turn tries again
+            return
+        self._cached_contents = list(prefix)
+        self._key = key
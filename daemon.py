@@ -0,0 +1,123 @@
+################################################################################
+#  warm background server for one-shot prompts                                 #
+#    python repl3.py --serve          start the server                         #
+#    python repl3.py "question"       is answered by the server if it runs     #
+#  the client side only needs the standard library                             #
+################################################################################
+import os, sys
+import json, socket
+
+
+# the socket lives in a directory only the user can enter. In the shared
+# temp dir another user could create it first and read the prompts.
+def socket_dir():
+    if runtime_dir := os.environ.get("XDG_RUNTIME_DIR"):
+        return f"{runtime_dir}/asllm"
+    return os.path.expanduser("~/.asllm")
+
+
+def socket_path():
+    return f"{socket_dir()}/daemon.sock"
+
+
+# the directory and the socket must belong to the user, the directory must
+# not be open to anyone else
+def is_private():
+    try:
+        directory, sock = os.stat(socket_dir()), os.stat(socket_path())
+    except OSError:
+        return False
+    return directory.st_uid == sock.st_uid == os.getuid() and not directory.st_mode & 0o077
+
+
+def connect():
+    if not hasattr(socket, "AF_UNIX") or not is_private():
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path())
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+# forwards the prompt to a running daemon and copies the rendered answer to
+# stdout, returns False if no daemon is running
+def ask(prompt, model=None, out=None):
+    out = out if out else sys.stdout
+    if not (sock := connect()):
+        return False
+
+    try:
+        width = os.get_terminal_size(out.fileno()).columns if out.isatty() else 80
+    except OSError:
+        width = 80
+    request = {"prompt": prompt, "model": model, "width": width, "terminal": out.isatty()}
+    with sock:
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        out.flush()
+        while data := sock.recv(65536):
+            out.buffer.write(data)
+            out.buffer.flush()
+    return True
+
+
+def serve():
+    import io, socketserver
+    import httpx
+    from google import genai
+    from google.genai import types
+    import gemini_search, metrics
+    from llm import Llm
+    from render import RichPrinter
+
+    # one client for all requests, its connection pool stays warm between calls
+    client = genai.Client(
+        api_key=os.environ.get("GEMINI_API_KEY"),
+        http_options=types.HttpOptions(client_args={"limits": httpx.Limits(max_keepalive_connections=20, keepalive_expiry=300)}),
+    )
+
+    class PromptRequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                request = json.loads(self.rfile.readline())
+                out = io.TextIOWrapper(self.wfile, encoding="utf-8", write_through=True)
+                printer = RichPrinter(stream=request.get("terminal", False))
+                printer.console = printer.console.__class__(file=out, width=request.get("width", 80), force_terminal=request.get("terminal", False))
+
+                llm = Llm(gemini=gemini_search.GeminiSearch(client=client), keep_parts=False)
+                if request.get("model"):
+                    llm.select_model(request["model"])
+                metrics.begin("daemon")
+                try:
+                    printer.render(llm.ask_llm(request["prompt"]))
+                finally:
+                    metrics.end()
+                out.flush()
+            except (ValueError, KeyError) as e:
+                self.wfile.write(f"daemon: invalid request: {e}\n".encode())
+            except BrokenPipeError:
+                pass
+
+    if sock := connect():
+        sock.close()
+        print(f"daemon is already running on {socket_path()}")
+        return
+    os.makedirs(socket_dir(), mode=0o700, exist_ok=True)
+    if os.stat(socket_dir()).st_uid != os.getuid():
+        print(f"{socket_dir()} belongs to another user", file=sys.stderr)
+        return
+    os.chmod(socket_dir(), 0o700)
+    if os.path.exists(socket_path()):
+        os.remove(socket_path())
+
+    with socketserver.ThreadingUnixStreamServer(socket_path(), PromptRequestHandler) as server:
+        os.chmod(socket_path(), 0o600)
+        print(f"listening on {socket_path()}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socket_path())
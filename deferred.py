@@ -0,0 +1,47 @@
+from google.genai import types
+
+
+# placeholder for an attachment whose Part is only built when the next request
+# is sent, e.g. the blobs of a resumed session. It looks like a Part without
+# text, inline_data or file_data to code that only inspects contents.
+class DeferredPart:
+    text = None
+    thought = None
+    inline_data = None
+    file_data = None
+
+    def __init__(self, resolve, mime_type, size=None, digest=None, description="attachment") -> None:
+        self._resolve = resolve
+        self.mime_type = mime_type
+        self.size = size
+        self.digest = digest
+        self.description = description
+
+    # False while resolve would still have to wait for a background job
+    def done(self):
+        return True
+
+    def failed(self):
+        return False
+
+    def resolve(self):
+        try:
+            return self._resolve()
+        except Exception as e:
+            return types.Part.from_text(text=f"[{self.description} is not available: {e}]")
+
+
+class DeferredContent:
+    def __init__(self, role, parts) -> None:
+        self.role = role
+        self.parts = parts
+
+    # None if all parts were dropped, e.g. attachments that failed to load
+    def resolve(self):
+        parts = [part.resolve() if isinstance(part, DeferredPart) else part for part in self.parts]
+        if not (parts := [part for part in parts if part is not None]):
+            return None
+        return types.Content(role=self.role, parts=parts)
+
+    def pending(self):
+        return [part for part in self.parts if isinstance(part, DeferredPart) and not part.done()]
@@ -1,8 +1,17 @@
 import mimetypes
 from typing import Protocol, Optional
-import requests
 import re
 import os, sys
+import mmap
+import hashlib
+
+class FileLoadError(Exception):
+    pass
+
+
+class FileTooLargeError(FileLoadError):
+    pass
+
 
 class FileLoader(Protocol):
     def load(self, file_name) -> bytes:
@@ -14,6 +23,21 @@ class FileLoader(Protocol):
     def validate(self, prompt) -> str:
         ...
 
+    def cache_key(self, file_name) -> (str | None):
+        ...
+
+    def discard(self, file_name) -> None:
+        ...
+
+
+
+# names the mimetypes module uses for types gemini knows under another name
+mimetype_aliases = {
+    "audio/x-wav": "audio/wav",
+    "audio/x-aiff": "audio/aiff",
+    "audio/x-flac": "audio/flac",
+    "video/quicktime": "video/mov",
+}
 
 
 class LocalFileLoader:
@@ -22,9 +46,18 @@ class LocalFileLoader:
             bin_data = f.read()
         return bin_data
 
+    def cache_key(self, file_name):
+        stat = os.stat(file_name)
+        return f"file:{os.path.abspath(file_name)}:{stat.st_mtime_ns}:{stat.st_size}"
+
+    def discard(self, file_name):
+        pass
+
     def get_mimetype(self, file_name):
-        mimetype = mimetypes.guess_type(file_name)
-        return mimetype[0]
+        mimetype = mimetypes.guess_type(file_name)[0]
+        if mimetype is None:
+            mimetype = sniff_file_mimetype(file_name)
+        return mimetype_aliases.get(mimetype, mimetype)
 
     def validate(self, prompt) -> str:
         if os.path.isfile(prompt.strip()):
@@ -51,19 +84,143 @@ class LocalFileLoader:
         return ""
 
 
+# leading bytes of the allowed file types, used when a server does not send a
+# useful Content-Type
+magic_numbers = (
+    (0, b"%PDF", "application/pdf"),
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (8, b"WEBP", "image/webp"),
+    (8, b"WAVE", "audio/wav"),
+    (8, b"AIFF", "audio/aiff"),
+    (0, b"fLaC", "audio/flac"),
+    (0, b"OggS", "audio/ogg"),
+    (0, b"ID3", "audio/mpeg"),
+    (0, b"\x1aE\xdf\xa3", "video/webm"),
+    (8, b"heic", "image/heic"),
+    (4, b"ftyp", "video/mp4"),
+)
+
+def sniff_mimetype(first_bytes) -> (str | None):
+    for offset, magic, mimetype in magic_numbers:
+        if first_bytes[offset:offset + len(magic)] == magic:
+            return mimetype
+    return None
+
+
+def sniff_file_mimetype(file_name) -> (str | None):
+    try:
+        with open(file_name, "rb") as f:
+            return sniff_mimetype(f.read(16))
+    except OSError:
+        return None
+
+
+# sha256 of a file through a memory map, without copying it into python
+# memory. Hashed windows are dropped from the mapping again, so the resident
+# size stays small for files of several GB.
+def hash_file(file_name, window_mb=64):
+    digest = hashlib.sha256()
+    window = window_mb * 1024 * 1024
+    with open(file_name, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return digest.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+            for start in range(0, size, window):
+                digest.update(view[start:start + window])
+                if hasattr(mapped, "madvise"):
+                    mapped.madvise(mmap.MADV_DONTNEED, start, min(window, size - start))
+    return digest.hexdigest()
+
+
+# fetches header and body with one streamed GET over a pooled session. The
+# open response is kept between get_mimetype and load, so a rejected file is
+# never downloaded beyond its first chunk. requests is imported on first use
+# to keep it out of the repl startup.
 class UrlFileLoader:
-    def __init__(self) -> None:
+    session = None
+    chunk_size = 64 * 1024
+
+    def __init__(self, connect_timeout=3.05, read_timeout=30, max_size_mb=2048) -> None:
         self.headers = {"User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:142.0) Gecko/20100101 Firefox/142.0"}
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self._pending = None
+
+    @classmethod
+    def get_session(cls):
+        import requests, requests.adapters
+        if cls.session is None:
+            cls.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=8, pool_maxsize=16)
+            cls.session.mount("http://", adapter)
+            cls.session.mount("https://", adapter)
+        return cls.session
+
+    def _open(self, file_name):
+        import requests
+        if self._pending and self._pending["url"] == file_name:
+            return self._pending
+
+        self.discard(None)
+        try:
+            response = self.get_session().get(file_name, stream=True, allow_redirects=True, timeout=self.timeout, headers=self.headers)
+        except requests.RequestException as e:
+            raise FileLoadError(e) from e
+        self._pending = {"url": file_name, "response": response, "chunks": response.iter_content(self.chunk_size), "first": None}
+        return self._pending
+
+    def _first_chunk(self, pending):
+        import requests
+        if pending["first"] is None:
+            try:
+                pending["first"] = next(pending["chunks"], b"")
+            except requests.RequestException as e:
+                raise FileLoadError(e) from e
+        return pending["first"]
 
     def load(self, file_name):
-        response = requests.get(file_name, allow_redirects=True, timeout=5, headers=self.headers) 
-        return response.content
+        import requests
+        pending = self._open(file_name)
+        self._pending = None
+        response = pending["response"]
+        try:
+            content_length = int(response.headers.get("Content-Length") or 0)
+            if content_length > self.max_size:
+                raise FileTooLargeError(f"{file_name} has {content_length} bytes, the limit is {self.max_size}")
+
+            body = [self._first_chunk(pending)]
+            size = len(body[0])
+            for chunk in pending["chunks"]:
+                size += len(chunk)
+                if size > self.max_size:
+                    raise FileTooLargeError(f"{file_name} is larger than the limit of {self.max_size} bytes")
+                body.append(chunk)
+        except requests.RequestException as e:
+            raise FileLoadError(e) from e
+        finally:
+            response.close()
+        return b"".join(body)
 
     def get_mimetype(self, file_name):
-        response = requests.head(file_name, allow_redirects=True, timeout=5, headers=self.headers)
-        content_type = response.headers.get('Content-Type')
+        pending = self._open(file_name)
+        content_type = pending["response"].headers.get('Content-Type', "").split(";")[0].strip().lower()
+        if content_type in ("", "application/octet-stream", "binary/octet-stream"):
+            content_type = sniff_mimetype(self._first_chunk(pending)) or content_type or None
         return content_type
 
+    def cache_key(self, file_name):
+        headers = self._open(file_name)["response"].headers
+        if version := headers.get('ETag') or headers.get('Last-Modified'):
+            return f"url:{file_name}:{version}"
+        return None
+
+    def discard(self, file_name):
+        if self._pending and file_name in (None, self._pending["url"]):
+            self._pending["response"].close()
+            self._pending = None
+
     def validate(self, prompt) -> str:
         pat = re.compile(r"^(https?:\/\/)?([\da-z\.-]+)\.([a-z\.]{2,6})([\/%\w\.-]*)*\/?$")
         if re.fullmatch(pat, prompt):
@@ -71,6 +228,37 @@ class UrlFileLoader:
         return ""
 
 
+# FileLoader that keeps loaded payloads in a BlobStore, keyed by the wrapped
+# loader's cache_key (path+mtime+size or url+ETag/Last-Modified)
+class CachingFileLoader:
+    def __init__(self, file_loader: FileLoader, blob_store) -> None:
+        self.file_loader = file_loader
+        self.blob_store = blob_store
+
+    def load(self, file_name):
+        key = self.file_loader.cache_key(file_name)
+        if key and (bin_data := self.blob_store.get(key)) is not None:
+            self.file_loader.discard(file_name)
+            return bin_data
+
+        bin_data = self.file_loader.load(file_name)
+        if key:
+            self.blob_store.put(key, bin_data)
+        return bin_data
+
+    def get_mimetype(self, file_name):
+        return self.file_loader.get_mimetype(file_name)
+
+    def validate(self, prompt) -> str:
+        return self.file_loader.validate(prompt)
+
+    def cache_key(self, file_name):
+        return self.file_loader.cache_key(file_name)
+
+    def discard(self, file_name):
+        self.file_loader.discard(file_name)
+
+
 class YoutubeValidator:
     @staticmethod
     def _match(prompt) -> Optional[re.Match]:
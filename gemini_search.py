@@ -1,11 +1,22 @@
 ################################################################################
 #               https://ai.google.dev/gemini-api/docs                          #
 ################################################################################
-import os
+import os, sys, io, gc, time
+import copy
+import asyncio
+import threading
+import itertools
+import concurrent.futures
+import hashlib, json, tempfile
+import httpx
 from google import genai
 from google.genai import types
-from google.genai.errors import ClientError, ServerError
-import models
+from google.genai.errors import APIError, ClientError, ServerError
+import models, metrics
+from resilience import RetryPolicy
+from context_cache import ContextCache
+from history import HistoryManager
+from deferred import DeferredPart, DeferredContent
 
 
 allowed_mimetypes = (
@@ -17,9 +28,105 @@ allowed_mimetypes = (
 )
 
 
-class GeminiSearch():
-    def __init__(self):
-        self.client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
+class UploadError(Exception):
+    pass
+
+
+# a file that is uploaded from its path. The SDK posts it in chunks with
+# httpx, whose responses sit in reference cycles that keep every chunk alive
+# until the garbage collector runs, so it is run before each chunk. That keeps
+# the memory of an upload at one chunk, whatever the size of the file. The
+# objects that exist when the first upload starts are frozen, the collection
+# only visits what was allocated since and does not hold the GIL for long.
+class UploadReader(io.FileIO):
+    _lock = threading.Lock()
+    _uploads = 0
+
+    def __enter__(self):
+        with UploadReader._lock:
+            if UploadReader._uploads == 0:
+                gc.freeze()
+            UploadReader._uploads += 1
+        return super().__enter__()
+
+    def __exit__(self, *exc_info):
+        with UploadReader._lock:
+            UploadReader._uploads -= 1
+            if UploadReader._uploads == 0:
+                gc.unfreeze()
+        return super().__exit__(*exc_info)
+
+    def read(self, size=-1):
+        gc.collect()
+        return super().read(size)
+
+
+# remembers the uri of files that went through the Files API, keyed by the
+# sha256 of their content and persisted in the temp dir, so the same file is
+# only uploaded again after the API has expired it. Uploads run on several
+# threads, use shared_upload_cache to get the one instance of a path.
+class UploadCache:
+    def __init__(self, path=None) -> None:
+        self.path = path if path else f"{tempfile.gettempdir()}/.llm-uploads.json"
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self._entries = self._read()
+        return self._entries
+
+    def get(self, digest):
+        with self._lock:
+            entry = self.entries.get(digest)
+        if entry and entry["expires"] > time.time() + 60:
+            return entry
+        return None
+
+    # (digest, entry) of an uploaded uri, or None
+    def find(self, uri):
+        with self._lock:
+            return next(((digest, entry) for digest, entry in self.entries.items() if entry["uri"] == uri), None)
+
+    # merges with what other processes wrote since the file was read
+    def put(self, digest, entry):
+        with self._lock:
+            now = time.time()
+            entries = {**self.entries, **self._read(), digest: entry}
+            self._entries = {key: value for key, value in entries.items() if value["expires"] > now}
+            try:
+                with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(self.path), prefix=".llm-uploads.", suffix=".tmp", delete=False) as f:
+                    json.dump(self._entries, f)
+                os.replace(f.name, self.path)
+            except OSError:
+                pass
+
+
+_upload_caches = {}
+_upload_caches_lock = threading.Lock()
+
+
+def shared_upload_cache(path=None):
+    path = path if path else f"{tempfile.gettempdir()}/.llm-uploads.json"
+    with _upload_caches_lock:
+        if path not in _upload_caches:
+            _upload_caches[path] = UploadCache(path)
+        return _upload_caches[path]
+
+
+# holds the conversation state and streams answers with the asyncio client
+# (client.aio), GeminiSearch below is the synchronous flavour of it
+class AsyncGeminiSearch():
+    def __init__(self, client=None):
+        self.client = client if client else genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
 
         self._system_instruction = ""
         self.tools_state = {"url_context":True, "google_search":True}
@@ -28,6 +135,33 @@ class GeminiSearch():
         self.model = self.known_models[1]()
         self.contents = []
 
+        # files larger than this go through the Files API instead of being inlined
+        self.upload_threshold_mb = 10
+        self.upload_cache = shared_upload_cache()
+        self.context_cache = ContextCache()
+        self.history = HistoryManager(self)
+        # optional response_cache.ResponseCache for replaying identical requests
+        self.response_cache = None
+        self.retry_policy = RetryPolicy()
+        # a structured.Schema makes the answers json instead of markdown
+        self.schema = None
+
+
+    # a copy of the conversation for a question that runs next to the main
+    # one. It shares the client and the upload, response and retry settings,
+    # gets its own list of contents and no context cache, so nothing it sends
+    # or receives changes the main conversation.
+    def fork(self, keep_history=True):
+        fork = copy.copy(self)
+        fork.model = copy.copy(self.model)
+        fork.tools_state = dict(self.tools_state)
+        fork.contents = list(self.contents) if keep_history else []
+        fork.context_cache = ContextCache()
+        fork.context_cache.enabled = False
+        fork.history = HistoryManager(fork, budget_tokens=self.history.budget_tokens)
+        fork.history.summarize = False
+        return fork
+
 
     @property
     def system_instruction(self):
@@ -35,11 +169,29 @@ class GeminiSearch():
 
     @system_instruction.setter
     def system_instruction(self, text):
+        if text != self._system_instruction:
+            self.context_cache.invalidate(self.client)
         self._system_instruction = text
 
 
+    @property
+    def json_schema(self):
+        return self.schema.json_schema if self.schema else None
+
+
+    def find_model(self, name):
+        for model_class in self.known_models:
+            model = model_class()
+            if name in (model.name, model.short_name):
+                return model
+        raise ValueError(f"unknown model: {name}")
+
+
     def make_tool_list(self):
         tools = []
+        # the api does not combine tools with a json answer
+        if self.schema:
+            return tools
         if self.tools_state['url_context']:
             tools += [types.Tool(url_context=types.UrlContext())]
         if self.tools_state['google_search']:
@@ -59,19 +211,78 @@ class GeminiSearch():
                 types.Part.from_text(text=text),
             ],
         )]
+        # a finished turn, summarize old turns in the background if the history got too long
+        if role == "model":
+            self.history.maybe_compact()
 
 
     def add_file_to_content(self, bin_data, mime_type):
         self.contents += [types.Content(
             role="user",
             parts=[
-                types.Part.from_bytes(
-                    mime_type=mime_type,
-                    data=bin_data,
-                ),
+                self.make_file_part(bin_data, mime_type),
             ],
         )]
 
+
+    def add_parts_to_content(self, parts):
+        self.contents += [types.Content(role="user", parts=parts)]
+
+
+    # parts that are still being loaded, resolved before the next request
+    def add_pending_parts_to_content(self, parts):
+        self.contents += [DeferredContent("user", parts)]
+
+
+    def pending_attachment_counts(self):
+        parts = [part for content in self.contents if isinstance(content, DeferredContent) for part in content.parts if isinstance(part, DeferredPart)]
+        return sum(not part.done() for part in parts), sum(part.failed() for part in parts), len(parts)
+
+
+    def make_file_part(self, bin_data, mime_type, upload=False):
+        if not upload and len(bin_data) <= self.upload_threshold_mb * 1024 * 1024:
+            return types.Part.from_bytes(mime_type=mime_type, data=bin_data)
+        return self.make_uploaded_part(hashlib.sha256(bin_data).hexdigest(), io.BytesIO(bin_data), mime_type)
+
+
+    def make_file_part_from_path(self, path, mime_type, digest, size):
+        if size <= self.upload_threshold_mb * 1024 * 1024:
+            with open(path, "rb") as f:
+                return types.Part.from_bytes(mime_type=mime_type, data=f.read())
+        return self.make_uploaded_part(digest, path, mime_type)
+
+
+    # file is a path or a binary file object. The path is remembered, so a
+    # saved session can upload the file again once the api expired it.
+    def make_uploaded_part(self, digest, file, mime_type):
+        if not (entry := self.upload_cache.get(digest)):
+            entry = self.upload_file(file, mime_type)
+            if isinstance(file, str):
+                entry["path"] = os.path.abspath(file)
+            self.upload_cache.put(digest, entry)
+        return types.Part.from_uri(file_uri=entry["uri"], mime_type=entry["mime_type"])
+
+
+    def upload_file(self, file, mime_type):
+        try:
+            if isinstance(file, str):
+                with UploadReader(file) as reader:
+                    uploaded = self.client.files.upload(file=reader, config=types.UploadFileConfig(mime_type=mime_type, display_name=os.path.basename(file)))
+            else:
+                uploaded = self.client.files.upload(file=file, config=types.UploadFileConfig(mime_type=mime_type))
+            # videos and audio are processed by the API before they can be used
+            while uploaded.state == types.FileState.PROCESSING:
+                time.sleep(1)
+                uploaded = self.client.files.get(name=uploaded.name)
+        except (ClientError, ServerError, httpx.TransportError) as e:
+            raise UploadError(e) from e
+
+        if uploaded.state == types.FileState.FAILED:
+            raise UploadError(f"processing of {uploaded.name} failed: {uploaded.error}")
+
+        expires = uploaded.expiration_time.timestamp() if uploaded.expiration_time else time.time() + 47 * 3600
+        return {"uri": uploaded.uri, "mime_type": uploaded.mime_type or mime_type, "expires": expires}
+
     def add_youtube_video_to_content(self, url):
         self.contents += [types.Content(
             role="user",
@@ -79,19 +290,261 @@ class GeminiSearch():
         )]
 
     def clear_contents(self):
+        self.context_cache.invalidate(self.client)
         self.contents = []
 
 
-    def generate_stream(self, user_prompt):
+    # waits for attachments that are still loading in the background
+    def resolve_deferred(self):
+        if any(isinstance(content, DeferredContent) for content in self.contents):
+            contents = [content.resolve() if isinstance(content, DeferredContent) else content for content in self.contents]
+            self.contents = [content for content in contents if content is not None]
+
+
+    def has_pending_attachments(self):
+        return any(isinstance(content, DeferredContent) and content.pending() for content in self.contents)
+
+
+    def prepare_request(self, user_prompt):
+        self.history.apply_pending()
+        self.resolve_deferred()
         tool_list = self.make_tool_list()
-        config = self.model.make_config(self._system_instruction, tool_list)
         self.add_content(role="user", text=user_prompt)
+        config = self.model.make_config(self._system_instruction, tool_list, json_schema=self.json_schema)
+        return {"model": self.model.name, "contents": self.contents, "config": config}
+
+
+    def apply_context_cache(self, request):
+        tool_list = self.make_tool_list()
+        contents, cached_content = self.context_cache.apply(self.client, self.model, self._system_instruction, tool_list, request["contents"])
+        config = self.model.make_config(self._system_instruction, tool_list, cached_content, self.json_schema)
+        return {"model": request["model"], "contents": contents, "config": config}
+
+
+    # returns the response cache key and the cached chunks, if there are any
+    def lookup_response(self, request):
+        if not self.response_cache:
+            return None, None
+        key = self.response_cache.make_key(request)
+        return key, self.response_cache.get(key)
+
+
+    def observe(self, chunk):
+        if request_metrics := metrics.current():
+            request_metrics.chunk_received()
+            if chunk.usage_metadata:
+                request_metrics.observe_usage(chunk.usage_metadata)
+        if chunk.usage_metadata:
+            self.context_cache.observe(chunk.usage_metadata)
+            self.history.observe(chunk.usage_metadata)
+
+
+    def request_sent(self, model_name):
+        if request_metrics := metrics.current():
+            request_metrics.request_sent(model_name)
+
+
+    # a turn that produced no answer must not leave its prompt in the history,
+    # the next request would send it again followed by the new prompt
+    def drop_unanswered(self, user_content):
+        if self.contents and self.contents[-1] is user_content:
+            self.contents.pop()
+
+
+    # the same request for flash, raced against a slow pro request. It is made
+    # before the context cache is applied, a cache only serves its own model.
+    def make_hedge_request(self, request):
+        if self.retry_policy.hedge_after_s is None or not isinstance(self.model, models.GEMINI_2_5_PRO):
+            return None
+        model = self.find_model("flash")
+        return {"model": model.name, "contents": request["contents"], "config": model.make_config(self._system_instruction, self.make_tool_list(), json_schema=self.json_schema)}
+
+
+    def retry_delay(self, error, attempt, started):
+        delay = self.retry_policy.next_delay(attempt, error, started)
+        if delay is not None:
+            reason = f"{error.code} {error.status}" if isinstance(error, APIError) else type(error).__name__
+            print(f"{reason}, retrying in {delay:.1f}s", file=sys.stderr)
+            if request_metrics := metrics.current():
+                request_metrics.retries += 1
+        return delay
+
+
+    def answered_by(self, model_name, request):
+        if model_name != request["model"] and (request_metrics := metrics.current()):
+            request_metrics.model = f"{model_name} (hedge)"
+
+
+    # stops a request that lost the race or outlived the deadline
+    @staticmethod
+    def _adiscard(task, streams):
+        def close(task):
+            if not task.cancelled() and task.exception() is None:
+                streams.close(task.result()[2])
+        task.cancel()
+        task.add_done_callback(close)
+
 
+    # waits for the first chunk, so a failed request can still be retried or
+    # hedged before anything was shown
+    async def _aopen_first(self, request, hedge_request, started, streams):
+        tasks = {asyncio.ensure_future(streams.open(request))}
+        hedge_at = time.monotonic() + self.retry_policy.hedge_after_s if hedge_request else None
+        error = None
+        try:
+            while tasks:
+                timeout = self.retry_policy.remaining(started)
+                if hedge_at:
+                    timeout = min(timeout, hedge_at - time.monotonic())
+                done, tasks = await asyncio.wait(tasks, timeout=max(0, timeout), return_when=asyncio.FIRST_COMPLETED)
+                winner = None
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif winner is None:
+                        winner = task
+                    else:
+                        self._adiscard(task, streams)
+                if winner:
+                    return winner.result()
+                if hedge_at and time.monotonic() >= hedge_at:
+                    tasks.add(asyncio.ensure_future(streams.open(hedge_request)))
+                    hedge_at = None
+                elif not done:
+                    raise TimeoutError(f"no answer from {request['model']} within {self.retry_policy.deadline_s:g}s")
+            raise error
+        finally:
+            for task in tasks:
+                self._adiscard(task, streams)
+
+
+    async def _aopen_with_retries(self, request, hedge_request, streams):
+        started = time.monotonic()
+        for attempt in itertools.count():
+            self.request_sent(request["model"])
+            try:
+                return await self._aopen_first(request, hedge_request, started, streams)
+            except (APIError, httpx.TransportError) as e:
+                delay = self.retry_delay(e, attempt, started)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+
+
+    # streams is AioStreams unless generate_stream drives this on its own loop
+    async def agenerate_stream(self, user_prompt, streams=None):
+        streams = streams if streams else AioStreams(self.client)
+        if self.has_pending_attachments():
+            with metrics.stage("attachments"):
+                await asyncio.to_thread(self.resolve_deferred)
+        with metrics.stage("prepare"):
+            request = self.prepare_request(user_prompt)
+            key, cached_chunks = self.lookup_response(request)
+        if cached_chunks is not None:
+            self.request_sent(f"{request['model']} (cached)")
+            for chunk in cached_chunks:
+                yield chunk
+            return
+
+        with metrics.stage("prepare"):
+            user_content = request["contents"][-1]
+            hedge_request = self.make_hedge_request(request)
+        chunks = []
+        answered = False
+        try:
+            # creating or refreshing the context cache is a blocking call
+            with metrics.stage("prepare"):
+                request = await asyncio.to_thread(self.apply_context_cache, request)
+            model_name, chunk, stream = await self._aopen_with_retries(request, hedge_request, streams)
+            self.answered_by(model_name, request)
+            while chunk is not None:
+                self.observe(chunk)
+                if key:
+                    chunks.append(chunk)
+                answered = True
+                yield chunk
+                chunk = await streams.next(stream)
+        except (APIError, httpx.TransportError, TimeoutError) as e:
+            print(e, file=sys.stderr)
+            return
+        finally:
+            if not answered:
+                self.drop_unanswered(user_content)
+
+        if key and chunks and model_name == request["model"]:
+            self.response_cache.put(key, chunks)
+
+
+# the stream primitives of agenerate_stream: open a request up to its first
+# chunk, read the next chunk, close a stream that is not read to the end
+class AioStreams:
+    def __init__(self, client) -> None:
+        self.client = client
+
+    async def open(self, request):
+        stream = await self.client.aio.models.generate_content_stream(**request)
+        return request["model"], await anext(stream, None), stream
+
+    async def next(self, stream):
+        return await anext(stream, None)
+
+    def close(self, stream):
+        asyncio.ensure_future(stream.aclose())
+
+
+# the same with the blocking client, only for the private loop of
+# GeminiSearch.generate_stream: next blocks the loop until the chunk is there.
+# Requests are opened on threads, that keeps the race for the first chunk.
+class BlockingStreams:
+    def __init__(self, client) -> None:
+        self.client = client
+
+    def _open(self, request):
+        stream = self.client.models.generate_content_stream(**request)
+        return request["model"], next(stream, None), stream
+
+    async def open(self, request):
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(self._open, request)
+        executor.shutdown(wait=False)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # the thread cannot be stopped, its stream is closed once it is open
+            def close(future):
+                if not future.cancelled() and future.exception() is None:
+                    future.result()[2].close()
+            future.add_done_callback(close)
+            raise
+
+    async def next(self, stream):
+        return next(stream, None)
+
+    def close(self, stream):
+        stream.close()
+
+
+# the same conversation for code without an event loop. generate_stream drives
+# agenerate_stream with the blocking client on an event loop of its own, so
+# retries, hedging and the deadline are implemented once. agenerate_stream
+# keeps the aio client, the loop of the repl is never blocked.
+class GeminiSearch(AsyncGeminiSearch):
+    # a bare loop, asyncio.Runner would install a signal handler for every chunk
+    def generate_stream(self, user_prompt):
+        loop = asyncio.new_event_loop()
+        stream = self.agenerate_stream(user_prompt, BlockingStreams(self.client))
         try:
-            for chunk in self.client.models.generate_content_stream(model=self.model.name, contents=self.contents, config=config):  
-               yield chunk
-        except (ClientError, ServerError) as e:
-            print(e)
+            while (chunk := loop.run_until_complete(anext(stream, None))) is not None:
+                yield chunk
+        finally:
+            loop.run_until_complete(stream.aclose())
+            # requests that lost the race close their streams when they are cancelled
+            if tasks := asyncio.all_tasks(loop):
+                for task in tasks:
+                    task.cancel()
+                loop.run_until_complete(asyncio.wait(tasks))
+            loop.run_until_complete(loop.shutdown_default_executor())
+            loop.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,139 @@
+################################################################################
+#        https://ai.google.dev/gemini-api/docs/tokens                          #
+################################################################################
+import threading
+from google.genai import types
+from google.genai.errors import ClientError, ServerError
+from deferred import DeferredPart
+
+
+summary_instruction = ("Summarize the conversation above for your own later reference. "
+                       "Keep facts, numbers, names, decisions and open questions, drop small talk. "
+                       "Answer with the summary only.")
+
+
+# rough local token estimate of a Content, calibrated later with usage_metadata
+def estimate_tokens(content) -> int:
+    tokens = 0
+    for part in content.parts or []:
+        if part.text:
+            tokens += len(part.text) // 4 + 1
+        elif part.inline_data:
+            tokens += estimate_media_tokens(part.inline_data.mime_type, len(part.inline_data.data or b""))
+        elif part.file_data:
+            tokens += estimate_media_tokens(part.file_data.mime_type, None)
+        elif isinstance(part, DeferredPart):
+            tokens += estimate_media_tokens(part.mime_type, part.size)
+    return tokens
+
+
+def estimate_media_tokens(mime_type, size) -> int:
+    mime_type = mime_type or ""
+    if mime_type.startswith("image/"):
+        return 258
+    if size is None:
+        # uploaded files or youtube videos, the size is unknown here
+        return 10000
+    if mime_type.startswith("text/"):
+        return size // 4
+    if mime_type == "application/pdf":
+        return max(258, size // 200)
+    if mime_type.startswith("audio/"):
+        return size // (5500 if mime_type in ("audio/wav", "audio/aiff") else 500)
+    if mime_type.startswith("video/"):
+        return size // 4000
+    return size // 4
+
+
+def is_pinned(content) -> bool:
+    return any(not part.text for part in content.parts or [])
+
+
+# keeps GeminiSearch.contents below budget_tokens. When the budget is exceeded
+# the oldest text turns are summarized with a cheap model on a background
+# thread, attachments stay verbatim. The summary replaces the turns on the
+# next request, so contents is only ever changed from the repl thread.
+class HistoryManager:
+    def __init__(self, gemini, budget_tokens=200_000, keep_recent=4, summary_model="gemini-2.5-flash-lite") -> None:
+        self.gemini = gemini
+        self.budget_tokens = budget_tokens
+        self.keep_recent = keep_recent
+        self.summary_model = summary_model
+        self.summarize = True
+        # ratio between real prompt tokens and the local estimate
+        self.scale = 1.0
+        self._worker = None
+        self._pending = None
+
+    @property
+    def context_tokens(self):
+        estimate = len(self.gemini.system_instruction) // 4 + sum(estimate_tokens(content) for content in self.gemini.contents)
+        return int(estimate * self.scale)
+
+    @property
+    def compacting(self):
+        return self._worker is not None and self._worker.is_alive()
+
+    def observe(self, usage_metadata):
+        if not (usage_metadata and usage_metadata.prompt_token_count):
+            return
+        estimate = len(self.gemini.system_instruction) // 4 + sum(estimate_tokens(content) for content in self.gemini.contents)
+        if estimate:
+            self.scale = 0.5 * self.scale + 0.5 * usage_metadata.prompt_token_count / estimate
+
+    def select_turns(self):
+        contents = self.gemini.contents
+        excess = self.context_tokens - int(0.7 * self.budget_tokens)
+        selected = []
+        freed = 0
+        for content in contents[:max(0, len(contents) - self.keep_recent)]:
+            if is_pinned(content):
+                continue
+            if freed >= excess and content.role == "user":
+                # stop at a turn boundary
+                break
+            selected.append(content)
+            freed += int(estimate_tokens(content) * self.scale)
+        return selected
+
+    def maybe_compact(self):
+        if self.compacting or self._pending or self.context_tokens <= self.budget_tokens:
+            return
+        if not (selected := self.select_turns()):
+            return
+        if not self.summarize:
+            self._pending = (selected, None)
+            return
+        self._worker = threading.Thread(target=self._summarize, args=(selected,), daemon=True)
+        self._worker.start()
+
+    def _summarize(self, selected):
+        try:
+            response = self.gemini.client.models.generate_content(
+                model=self.summary_model,
+                contents=selected + [types.Content(role="user", parts=[types.Part.from_text(text=summary_instruction)])],
+                config=types.GenerateContentConfig(thinking_config=types.ThinkingConfig(thinking_budget=0)),
+            )
+            summary = response.text
+        except (ClientError, ServerError):
+            summary = None
+        self._pending = (selected, summary)
+
+    # called from the repl thread before a request is built
+    def apply_pending(self):
+        if not self._pending:
+            return False
+        selected, summary = self._pending
+        self._pending = None
+        contents = self.gemini.contents
+        positions = [index for index, content in enumerate(contents) if any(content is s for s in selected)]
+        if len(positions) != len(selected):
+            # history was cleared or changed meanwhile
+            return False
+
+        compacted = [content for content in contents if not any(content is s for s in selected)]
+        if summary:
+            compacted.insert(positions[0], types.Content(role="user", parts=[
+                types.Part.from_text(text=f"Summary of the earlier conversation:\n{summary}")]))
+        self.gemini.contents = compacted
+        return True
@@ -0,0 +1,199 @@
+################################################################################
+#  json records in answers: the elements of a top level array or the top       #
+#  level object, from ```json blocks or from a plain json answer               #
+################################################################################
+import sys
+import json
+import re
+
+
+# the records in the ```json blocks of a complete answer: the elements of a
+# top level array, or the top level object itself. Blocks that are not valid
+# json are skipped.
+class JsonExtractor:
+    def __init__(self) -> None:
+        pass
+
+    def extract(self, text):
+        json_strings = re.findall(r"(?<=```json).*?(?=```)", text, flags=re.MULTILINE| re.DOTALL)
+        result = []
+        for json_string in json_strings:
+            try:
+                value = json.loads(json_string)
+            except (json.JSONDecodeError, TypeError):
+                continue
+            if isinstance(value, list):
+                result += value
+            else:
+                result.append(value)
+        return result
+
+
+# the same records while the answer streams: every element of a top level
+# array, or top level object, in a ```json block is returned by feed as soon
+# as it is closed. Every character is scanned once, only the record that is
+# still open is kept. With fenced=False the text is json without a fence.
+class StreamingJsonExtractor:
+    fence_open = re.compile(r"^[ \t]*```json[^\n]*\n", re.MULTILINE | re.IGNORECASE)
+    string_special = re.compile(r'["\\]')
+    structural = re.compile(r'["{}\[\],`]')
+    non_space = re.compile(r"\S")
+
+    def __init__(self, fenced=True) -> None:
+        self.errors = 0
+        # top level values that were closed, and "[" or "{" for the last one
+        self.closed = 0
+        self.top_level = None
+        self._line = ""
+        self._in_fence = not fenced
+        self._reset_block()
+
+    def _reset_block(self):
+        self._depth = 0
+        self._top = None
+        self._in_string = False
+        self._escape = False
+        self._record = None
+
+    def feed(self, text):
+        records = []
+        i = 0
+        while i < len(text):
+            if self._in_fence:
+                i = self._scan(text, i, records)
+                continue
+            # outside a block only the unfinished last line is kept
+            text, i = self._line + text[i:], 0
+            self._line = ""
+            if not (match := self.fence_open.search(text)):
+                self._line = text[text.rfind("\n") + 1:]
+                break
+            self._in_fence = True
+            i = match.end()
+        return records
+
+    # generators that pass the deltas of Llm.ask_llm on and hand every record
+    # to on_record as soon as it is complete
+    def follow(self, deltas, on_record):
+        for delta in deltas:
+            for record in self.feed(delta["text"]):
+                on_record(record)
+            yield delta
+
+    async def afollow(self, deltas, on_record):
+        async for delta in deltas:
+            for record in self.feed(delta["text"]):
+                on_record(record)
+            yield delta
+
+    @classmethod
+    def records(cls, deltas):
+        extractor = cls()
+        for delta in deltas:
+            yield from extractor.feed(delta["text"])
+
+    def _close_top(self):
+        self.closed += 1
+        self.top_level, self._top, self._depth = self._top, None, 0
+
+    def _emit(self, text, start, end, records):
+        self._record.append(text[start:end])
+        try:
+            records.append(json.loads("".join(self._record)))
+        except ValueError:
+            self.errors += 1
+        self._record = None
+
+    # scans text[i:] inside a block, returns where the block ended or len(text)
+    def _scan(self, text, i, records):
+        start = 0 if self._record is not None else None
+        if self._escape:
+            self._escape = False
+            i += 1
+        while i < len(text):
+            if self._in_string:
+                if not (match := self.string_special.search(text, i)):
+                    i = len(text)
+                    break
+                i = match.end()
+                if match.group() == "\\":
+                    if i == len(text):
+                        self._escape = True
+                    i += 1
+                else:
+                    self._in_string = False
+                continue
+
+            if self._record is None:
+                # between records: the next character opens one, a top level array or ends the block
+                if not (match := self.non_space.search(text, i)):
+                    i = len(text)
+                    break
+                char, i = match.group(), match.start()
+                if char == "`":
+                    self._in_fence = False
+                    self._reset_block()
+                    return i
+                if self._depth == 0 and char == "[":
+                    self._top, self._depth = "[", 1
+                    i += 1
+                    continue
+                if self._depth == 1 and char in ",]":
+                    if char == "]":
+                        self._close_top()
+                    i += 1
+                    continue
+                if self._depth == 0 and char != "{":
+                    i += 1
+                    continue
+                if self._depth == 0:
+                    self._top = "{"
+                self._record, start = [], i
+
+            if not (match := self.structural.search(text, i)):
+                i = len(text)
+                break
+            char, i = match.group(), match.end()
+            if char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 0 and self._top == "{":
+                    self._emit(text, start, i, records)
+                    self._close_top()
+                elif self._depth == 1 and self._top == "[":
+                    self._emit(text, start, i, records)
+                elif self._depth == 0:
+                    # a scalar was the last element of the array
+                    self._emit(text, start, i - 1, records)
+                    self._close_top()
+            elif char == "," and self._depth == 1 and self._top == "[":
+                self._emit(text, start, i - 1, records)
+            elif char == "`":
+                # the block ended inside a record, it is dropped
+                self.errors += 1
+                self._in_fence = False
+                self._reset_block()
+                return i - 1
+        if self._record is not None:
+            self._record.append(text[start:])
+        return i
+
+
+# writes records as json lines while they are extracted, - is stdout
+class JsonlSink:
+    def __init__(self, path) -> None:
+        self.path = path
+        self.file = sys.stdout if path == "-" else open(path, "a")
+        self.count = 0
+
+    def write(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+        self.count += 1
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
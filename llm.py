@@ -0,0 +1,249 @@
+################################################################################
+#  the chat with the model: history, model selection and the answer of a       #
+#  turn as it streams. Used by the repl, the batch mode and the daemon.        #
+################################################################################
+import threading
+import contextlib
+import re
+import metrics
+
+
+override_prefix = re.compile(r"@(pro|flash|lite)\s+")
+
+
+class Llm:
+    def __init__(self, gemini=None, keep_parts=True, model=None, context_budget=None, cache_responses=False, hedge_after=None, deadline=None, router=None, schema=None) -> None:
+        self.keep_parts = keep_parts
+        self._current_model_index = 1
+        self.auto_route = False
+        self.last_route = None
+        self._router = router
+        self._current_instruction_index = 0
+        self._instruction_list = [{"name":"std", "instruction":''},
+                            {"name":"short", "instruction":'answer short and precise, do not explain, just answer the question. If the prompt starts with "exp", give a detailed answer with explanation.'},
+                            {"name":"custom", "instruction":''}]
+
+        self._gemini = gemini
+        self._gemini_error = None
+        self._gemini_loader = None
+        if gemini is None:
+            # importing google.genai and building the client dominate the startup
+            # time, do it in the background while the first prompt is typed
+            self._gemini_loader = threading.Thread(target=self._load_gemini, args=(model, context_budget, cache_responses, hedge_after, deadline, schema), daemon=True)
+            self._gemini_loader.start()
+
+    def _load_gemini(self, model, context_budget, cache_responses, hedge_after, deadline, schema):
+        try:
+            import gemini_search
+            gemini = gemini_search.GeminiSearch()
+            if model == "auto":
+                self.auto_route = True
+                self._current_model_index = len(gemini.known_models)
+            elif model:
+                gemini.model = gemini.find_model(model)
+                self._current_model_index = [model_class.__name__ for model_class in gemini.known_models].index(type(gemini.model).__name__)
+            if context_budget:
+                gemini.history.budget_tokens = context_budget
+            if cache_responses:
+                import response_cache
+                gemini.response_cache = response_cache.ResponseCache()
+            gemini.retry_policy.hedge_after_s = hedge_after
+            if deadline:
+                gemini.retry_policy.deadline_s = deadline
+            gemini.schema = schema
+            self._gemini = gemini
+        except Exception as e:
+            self._gemini_error = e
+
+    @property
+    def gemini(self):
+        if self._gemini_loader:
+            self._gemini_loader.join()
+            if self._gemini_error:
+                raise self._gemini_error
+        return self._gemini
+
+    def gemini_ready(self):
+        return self._gemini is not None
+
+    @property
+    def active_instruction(self):
+        return self._instruction_list[self._current_instruction_index]
+
+    def activate_next_instruction(self):
+        self._current_instruction_index = (self._current_instruction_index + 1) % len(self._instruction_list)
+        self.gemini.system_instruction = self.active_instruction["instruction"]
+        return self.active_instruction
+
+    def set_custom_instruction(self, text):
+        self._instruction_list[2]["instruction"] = text
+        self._current_instruction_index = 2
+        self.gemini.system_instruction = self.active_instruction["instruction"]
+
+    # align the F2/F5 selection with the state of a resumed session
+    def sync_selection(self):
+        self.auto_route = False
+        self._current_model_index = [model.__name__ for model in self.gemini.known_models].index(type(self.gemini.model).__name__)
+        instructions = [entry["instruction"] for entry in self._instruction_list[:2]]
+        if self.gemini.system_instruction in instructions:
+            self._current_instruction_index = instructions.index(self.gemini.system_instruction)
+        else:
+            self._instruction_list[2]["instruction"] = self.gemini.system_instruction
+            self._current_instruction_index = 2
+
+    # the cycle ends with auto routing
+    def activate_next_model(self):
+        self._current_model_index = (self._current_model_index + 1) % (len(self.gemini.known_models) + 1)
+        self.auto_route = self._current_model_index == len(self.gemini.known_models)
+        if not self.auto_route:
+            self.gemini.model = self.gemini.known_models[self._current_model_index]()
+
+    def select_model(self, name):
+        if name == "auto":
+            self.auto_route = True
+            self._current_model_index = len(self.gemini.known_models)
+        else:
+            self.gemini.model = self.gemini.find_model(name)
+            self.sync_selection()
+
+    @property
+    def router(self):
+        if self._router is None:
+            import router
+            self._router = router.shared()
+        return self._router
+
+    # picks the model of one request: a prompt starting with "@pro ", "@flash "
+    # or "@lite " uses that model once, in auto mode the router picks it.
+    # gemini is a fork for background questions, only the main conversation
+    # counts for escalations.
+    @contextlib.contextmanager
+    def routing(self, prompt, gemini=None):
+        main = gemini is None
+        gemini = self.gemini if main else gemini
+        previous_model, route = gemini.model, None
+        if match := override_prefix.match(prompt):
+            prompt = prompt[match.end():]
+            gemini.model = gemini.find_model(match.group(1))
+            import router
+            if main and self.last_route and router.is_escalation(self.last_route, match.group(1)):
+                self.router.escalate(self.last_route)
+        elif self.auto_route:
+            route = self.router.choose(gemini, prompt, short=self.active_instruction["name"] == "short")
+            gemini.model = route.make_model(gemini)
+        completed = False
+        try:
+            yield prompt
+            completed = True
+        finally:
+            if match:
+                gemini.model = previous_model
+            request_metrics = metrics.current()
+            if route and request_metrics:
+                request_metrics.route = str(route)
+                if completed and not (request_metrics.model or "").endswith("(cached)"):
+                    self.router.record(route, request_metrics.ttft_s)
+            if main:
+                self.last_route = route
+
+
+    @property
+    def use_url_context_tool(self):
+        return self.gemini.tools_state["url_context"]
+
+    @use_url_context_tool.setter
+    def use_url_context_tool(self, value):
+        self.gemini.tools_state["url_context"] = value
+
+
+    @property
+    def use_google_search_tool(self):
+        return self.gemini.tools_state["google_search"]
+
+    @use_google_search_tool.setter
+    def use_google_search_tool(self, value):
+        self.gemini.tools_state["google_search"] = value
+
+
+    def has_history(self):
+        return self.gemini.contents != []
+
+
+    def clear_history(self):
+        self.gemini.clear_contents()
+
+
+    # yields one delta per chunk: only the new text and the new metadata,
+    # use a ResponseAccumulator to collect the complete answer
+    def ask_llm(self, prompt, gemini=None):
+        with self.routing(prompt, gemini) as prompt:
+            for chunk in (gemini or self.gemini).generate_stream(prompt):
+                with metrics.stage("ask_llm"):
+                    delta = self.make_delta(chunk)
+                yield delta
+
+
+    async def ask_llm_async(self, prompt, gemini=None):
+        with self.routing(prompt, gemini) as prompt:
+            async for chunk in (gemini or self.gemini).agenerate_stream(prompt):
+                with metrics.stage("ask_llm"):
+                    delta = self.make_delta(chunk)
+                yield delta
+
+
+    def make_delta(self, chunk):
+        delta = {"text": "", "grounding_chunks": (), "url_metadata": (), "parts": ()}
+        if not chunk.candidates:
+            return delta
+
+        candidate = chunk.candidates[0]
+        if candidate.content and candidate.content.parts:
+            delta["text"] = "".join(part.text for part in candidate.content.parts if part.text and not part.thought)
+            if self.keep_parts:
+                delta["parts"] = candidate.content.parts
+
+        if self.gemini.tools_state['google_search']:
+            if candidate.grounding_metadata and candidate.grounding_metadata.grounding_chunks:
+                delta["grounding_chunks"] = candidate.grounding_metadata.grounding_chunks
+
+        if self.gemini.tools_state['url_context']:
+            if candidate.url_context_metadata and candidate.url_context_metadata.url_metadata:
+                delta["url_metadata"] = candidate.url_context_metadata.url_metadata
+
+        return delta
+
+
+class ResponseAccumulator:
+    def __init__(self) -> None:
+        self._fragments = []
+        self.grounding_chunks = []
+        self.url_metadata = []
+        self.parts = []
+
+    def add(self, delta):
+        if delta["text"]:
+            self._fragments.append(delta["text"])
+        self.grounding_chunks += delta["grounding_chunks"]
+        self.url_metadata += delta["url_metadata"]
+        self.parts += delta["parts"]
+
+    # does not change the fragments, the comparison view reads it from the
+    # refresh thread of rich while the event loop adds to them
+    @property
+    def model_output(self):
+        return "".join(self._fragments)
+
+    def result(self):
+        return {
+            "model_output": self.model_output,
+            "grounding_chunks": self.grounding_chunks,
+            "url_metadata": self.url_metadata,
+            "parts": self.parts,
+            }
+
+    @classmethod
+    def collect(cls, deltas):
+        accumulator = cls()
+        for delta in deltas:
+            accumulator.add(delta)
+        return accumulator.result()
@@ -0,0 +1,151 @@
+import time
+import contextvars, json, tempfile
+import logging, logging.handlers
+from contextlib import contextmanager
+
+
+log_path = f"{tempfile.gettempdir()}/.llm-metrics.jsonl"
+_current = contextvars.ContextVar("current_request_metrics", default=None)
+_logger = None
+last = None
+
+
+def get_logger():
+    global _logger
+    if _logger is None:
+        _logger = logging.getLogger("asllm.metrics")
+        _logger.propagate = False
+        _logger.setLevel(logging.INFO)
+        handler = logging.handlers.RotatingFileHandler(log_path, maxBytes=5 * 1024 * 1024, backupCount=3, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        _logger.addHandler(handler)
+    return _logger
+
+
+# timings and token counts of one request, collected by whatever code runs
+# while it is the current request of the thread or task
+class RequestMetrics:
+    def __init__(self, kind) -> None:
+        self.kind = kind
+        self.model = None
+        self.route = None
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self._request_sent = None
+        self._first_chunk = None
+        self._last_chunk = None
+        self.total_s = None
+        self.retries = 0
+        self.stages = {}
+        self.usage = {}
+
+    def add_stage_time(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def request_sent(self, model):
+        self.model = model
+        self._request_sent = time.perf_counter()
+
+    def chunk_received(self):
+        now = time.perf_counter()
+        if self._first_chunk is None:
+            self._first_chunk = now
+        self._last_chunk = now
+
+    def observe_usage(self, usage_metadata):
+        self.usage = {
+            "input_tokens": usage_metadata.prompt_token_count or 0,
+            "cached_tokens": usage_metadata.cached_content_token_count or 0,
+            "output_tokens": usage_metadata.candidates_token_count or 0,
+            "thinking_tokens": usage_metadata.thoughts_token_count or 0,
+        }
+
+    @property
+    def ttft_s(self):
+        if self._request_sent is None or self._first_chunk is None:
+            return None
+        return self._first_chunk - self._request_sent
+
+    @property
+    def stream_s(self):
+        if self._first_chunk is None:
+            return None
+        return self._last_chunk - self._first_chunk
+
+    @property
+    def tokens_per_s(self):
+        output_tokens = self.usage.get("output_tokens", 0) + self.usage.get("thinking_tokens", 0)
+        if not output_tokens or not self.stream_s:
+            return None
+        return output_tokens / self.stream_s
+
+    def finish(self):
+        self.total_s = time.perf_counter() - self._start
+
+    def to_dict(self):
+        def rounded(value):
+            return round(value, 4) if isinstance(value, float) else value
+        return {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "kind": self.kind,
+            "model": self.model,
+            "route": self.route,
+            "total_s": rounded(self.total_s),
+            "ttft_s": rounded(self.ttft_s),
+            "stream_s": rounded(self.stream_s),
+            "tokens_per_s": rounded(self.tokens_per_s),
+            "retries": self.retries,
+            **self.usage,
+            "stages": {name: rounded(seconds) for name, seconds in self.stages.items()},
+        }
+
+    def summary(self):
+        parts = []
+        if self.retries:
+            parts.append(f"{self.retries} retries")
+        if self.ttft_s is not None:
+            parts.append(f"ttft {self.ttft_s:.2f}s")
+        if self.tokens_per_s:
+            parts.append(f"{self.tokens_per_s:.0f} tok/s")
+        if self.usage:
+            parts.append(f"in {self.usage['input_tokens']} out {self.usage['output_tokens']} think {self.usage['thinking_tokens']}")
+        parts += [f"{name} {seconds:.2f}s" for name, seconds in self.stages.items()]
+        if self.total_s is not None:
+            parts.append(f"total {self.total_s:.2f}s")
+        return "  ".join(parts)
+
+
+def current():
+    return _current.get()
+
+
+def begin(kind):
+    metrics = RequestMetrics(kind)
+    _current.set(metrics)
+    return metrics
+
+
+# finishes the current request and appends it to the metrics log, requests
+# that did nothing measurable (empty prompts, commands) are not logged
+def end():
+    global last
+    metrics = _current.get()
+    if metrics is None:
+        return None
+    _current.set(None)
+    metrics.finish()
+    if metrics.stages or metrics.model:
+        last = metrics
+        get_logger().info(json.dumps(metrics.to_dict()))
+    return metrics
+
+
+@contextmanager
+def stage(name):
+    metrics = _current.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if metrics is not None:
+            metrics.add_stage_time(name, time.perf_counter() - start)
@@ -6,12 +6,18 @@ class GeminiModel:
         self.name = None
         self.short_name = None
 
-    def make_config(self, system_instruction, tool_list):
+    # with a json schema the answer is json that follows it, not markdown
+    def make_config(self, system_instruction, tool_list, cached_content=None, json_schema=None):
+        if cached_content:
+            # instruction and tools are part of the cached content
+            system_instruction, tool_list = None, None
         config = types.GenerateContentConfig(
             thinking_config=types.ThinkingConfig(thinking_budget=self.thinking_budget),
             tools=tool_list,
             system_instruction=system_instruction,
-            response_mime_type="text/plain",
+            response_mime_type="application/json" if json_schema else "text/plain",
+            response_json_schema=json_schema,
+            cached_content=cached_content,
         )
         return config
 
@@ -0,0 +1,159 @@
+################################################################################
+#  shrinks attachments before they are sent: large images are downscaled and   #
+#  recompressed, uncompressed audio is transcoded to opus and pdfs can be cut  #
+#  to a page range (file.pdf#pages=3-7). Pillow, pypdf and the ffmpeg binary   #
+#  are optional, a step whose tool is missing leaves the file as it is.        #
+################################################################################
+import os, io, re
+import hashlib
+import shutil
+import subprocess
+import tempfile
+import importlib.util
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+class PreprocessError(Exception):
+    pass
+
+
+def parse_pages(pages, num_pages):
+    indices = []
+    for page_range in pages.split(","):
+        if not (match := re.fullmatch(r"\s*(\d+)\s*(?:(-)\s*(\d*)\s*)?", page_range)):
+            raise PreprocessError(f"invalid page range: {pages}")
+        first = int(match.group(1))
+        last = (int(match.group(3)) if match.group(3) else num_pages) if match.group(2) else first
+        if first < 1 or last < first or first > num_pages:
+            raise PreprocessError(f"page range {page_range.strip()} is outside of 1-{num_pages}")
+        indices += range(first - 1, min(last, num_pages))
+    return indices
+
+
+# the steps run in worker processes, they return (data, mimetype) or None when
+# the file is better sent unchanged
+
+def downscale_image(data, max_edge, quality):
+    from PIL import Image, ImageOps
+    with Image.open(io.BytesIO(data)) as image:
+        if max(image.size) <= max_edge and len(data) < 1024 * 1024:
+            return None
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_edge, max_edge))
+        out = io.BytesIO()
+        if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+            image.save(out, format="WEBP", quality=quality)
+            mimetype = "image/webp"
+        else:
+            image.convert("RGB").save(out, format="JPEG", quality=quality, optimize=True)
+            mimetype = "image/jpeg"
+    if out.tell() >= len(data):
+        return None
+    return out.getvalue(), mimetype
+
+
+def transcode_audio(data, suffix, bitrate_kbps):
+    if not (ffmpeg := shutil.which("ffmpeg")):
+        return None
+    # ffmpeg needs to seek in some containers, so the input goes through a file
+    with tempfile.NamedTemporaryFile(suffix=suffix) as f:
+        f.write(data)
+        f.flush()
+        result = subprocess.run([ffmpeg, "-hide_banner", "-loglevel", "error", "-i", f.name, "-vn", "-ac", "1",
+                                 "-c:a", "libopus", "-b:a", f"{bitrate_kbps}k", "-f", "ogg", "pipe:1"], capture_output=True)
+    if result.returncode != 0:
+        raise PreprocessError(f"ffmpeg failed: {result.stderr.decode(errors='replace').strip()}")
+    if len(result.stdout) >= len(data):
+        return None
+    return result.stdout, "audio/ogg"
+
+
+def select_pages(data, pages):
+    try:
+        import pypdf
+    except ImportError:
+        raise PreprocessError("page ranges need pypdf, pip install pypdf")
+    reader = pypdf.PdfReader(io.BytesIO(data))
+    writer = pypdf.PdfWriter()
+    for index in parse_pages(pages, len(reader.pages)):
+        writer.add_page(reader.pages[index])
+    out = io.BytesIO()
+    writer.write(out)
+    return out.getvalue(), "application/pdf"
+
+
+audio_suffixes = {"audio/wav": ".wav", "audio/aiff": ".aiff", "audio/flac": ".flac"}
+
+
+# results are kept in a BlobStore under the sha256 of the input and the step.
+# With shrink=False only the page ranges the user asked for are applied.
+class Preprocessor:
+    def __init__(self, blob_store, shrink=True, max_edge=2048, jpeg_quality=85, audio_bitrate_kbps=32, min_image_kb=512, workers=None) -> None:
+        self.blob_store = blob_store
+        self.shrink = shrink
+        self.max_edge = max_edge
+        self.jpeg_quality = jpeg_quality
+        self.audio_bitrate_kbps = audio_bitrate_kbps
+        self.min_image_size = min_image_kb * 1024
+        self.workers = workers if workers else min(4, os.cpu_count() or 1)
+        self.has_pillow = importlib.util.find_spec("PIL") is not None
+        self.has_ffmpeg = shutil.which("ffmpeg") is not None
+        self._pool = None
+
+    # started on first use, spawn keeps the threads of the repl out of the workers
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    # returns (recipe, function, arguments after the data) or None if the
+    # file is sent as it is
+    def make_step(self, mimetype, size, pages=None):
+        if pages:
+            if mimetype != "application/pdf":
+                raise PreprocessError(f"page ranges only work for pdfs, not {mimetype}")
+            return f"pages:{pages}", select_pages, (pages,)
+        if not self.shrink:
+            return None
+        if mimetype.startswith("image/") and self.has_pillow and size >= self.min_image_size:
+            return f"image:{self.max_edge}:{self.jpeg_quality}", downscale_image, (self.max_edge, self.jpeg_quality)
+        if mimetype in audio_suffixes and self.has_ffmpeg:
+            return f"audio:{self.audio_bitrate_kbps}", transcode_audio, (audio_suffixes[mimetype], self.audio_bitrate_kbps)
+        return None
+
+    # blocks until the worker is done, call it from several threads to
+    # preprocess several files at once
+    def process(self, data, mimetype, pages=None):
+        if not (step := self.make_step(mimetype, len(data), pages)):
+            return data, mimetype
+        recipe, function, args = step
+        key = f"preprocess:{hashlib.sha256(data).hexdigest()}:{recipe}"
+        if (entry := self.blob_store.lookup(key)) and (cached := self.blob_store.get(key)) is not None:
+            return cached, entry["mimetype"]
+
+        try:
+            result = self.pool.submit(function, data, *args).result()
+        except PreprocessError:
+            raise
+        except BrokenProcessPool as e:
+            # a crashed worker breaks the pool, the next file gets a new one
+            self._pool = None
+            if pages:
+                raise PreprocessError(f"could not select pages: {e}") from e
+            return data, mimetype
+        except Exception as e:
+            # a file the tools cannot read is sent as it is
+            if pages:
+                raise PreprocessError(f"could not select pages: {e}") from e
+            return data, mimetype
+        data, mimetype = result if result else (data, mimetype)
+        self.blob_store.put(key, data, mimetype=mimetype)
+        return data, mimetype
+
+    def shutdown(self):
+        if self._pool:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -0,0 +1,267 @@
+################################################################################
+#  rendering of answers in the terminal: streamed markdown, progress dashes,   #
+#  json records of structured answers, links and metrics                       #
+################################################################################
+import time
+import json, re
+from rich.console import Console
+from rich.markdown import Markdown
+import metrics
+from llm import ResponseAccumulator
+
+
+# splits growing markdown into finished blocks and the unfinished tail; only
+# newly completed lines are scanned. A blank line outside a code fence ends a
+# block once the next line starts at column 0 and does not continue a list,
+# so indented continuations and loose lists stay together in the tail.
+class MarkdownStream:
+    list_item = re.compile(r"\s*([-*+]|\d{1,9}[.)])(\s|$)")
+
+    def __init__(self) -> None:
+        self.tail = ""
+        self._scan_pos = 0
+        self._in_fence = False
+        self._in_list = False
+        # end of the last blank line while it is open whether the block ended there
+        self._boundary = None
+
+    def feed(self, text):
+        self.tail += text
+        finished = []
+        while (line_end := self.tail.find("\n", self._scan_pos)) != -1:
+            line = self.tail[self._scan_pos:line_end]
+            self._scan_pos = line_end + 1
+            stripped = line.strip()
+            if self._boundary is not None and stripped:
+                if not (line[0].isspace() or self._in_list and self.list_item.match(line)):
+                    finished.append(self.tail[:self._boundary])
+                    self.tail = self.tail[self._boundary:]
+                    self._scan_pos -= self._boundary
+                    self._in_list = False
+                self._boundary = None
+            if stripped.startswith("```") or stripped.startswith("~~~"):
+                self._in_fence = not self._in_fence
+            elif not self._in_fence and stripped == "" and self.tail[:self._scan_pos].strip():
+                self._boundary = self._scan_pos
+            elif not self._in_fence and self.list_item.match(line):
+                self._in_list = True
+        return finished
+
+
+# renders the deltas of one answer, a dash per chunk and the answer at the end
+class ProgressOutput:
+    def __init__(self, printer) -> None:
+        self.printer = printer
+        self.accumulator = None
+        self.result = {}
+        self._num_dots = 0
+
+    def __enter__(self):
+        return self
+
+    def add(self, delta):
+        with metrics.stage("render"):
+            self.accumulator = self.accumulator or ResponseAccumulator()
+            self.accumulator.add(delta)
+            self.printer.console.print("\r[#00ff00]" + "-", end="")
+            self._num_dots += 1
+
+    def __exit__(self, *exc_info):
+        with metrics.stage("render"):
+            console = self.printer.console
+            console.print("\r[#00ff00]" + "-" * (console.width - self._num_dots) + "[/#00ff00]")
+            if self.accumulator:
+                self.result = self.accumulator.result()
+                self.printer.print_result(self.result)
+
+
+spaced_elements = {"bullet_list_open", "ordered_list_open", "blockquote_open", "table_open"}
+
+
+# renders the deltas of one answer as markdown while they arrive, finished
+# blocks are printed once, only the unfinished tail is re-rendered
+class StreamingOutput:
+    def __init__(self, printer) -> None:
+        self.printer = printer
+        self.accumulator = None
+        self.result = {}
+        self._markdown_stream = MarkdownStream()
+        self._min_interval = 1 / printer.refresh_per_second
+        self._last_render = 0.0
+        self._separate = False
+        from rich.live import Live
+        self._live = Live(console=printer.console, refresh_per_second=printer.refresh_per_second, transient=True)
+
+    def __enter__(self):
+        console = self.printer.console
+        console.print("[#00ff00]" + "-" * console.width + "[/#00ff00]")
+        self._live.start()
+        return self
+
+    def add(self, delta):
+        with metrics.stage("render"):
+            self.accumulator = self.accumulator or ResponseAccumulator()
+            self.accumulator.add(delta)
+            for block in self._markdown_stream.feed(delta["text"]):
+                self._print_block(self._live.console, block)
+
+            now = time.monotonic()
+            if now - self._last_render >= self._min_interval:
+                self._live.update(Markdown(self._markdown_stream.tail))
+                self._last_render = now
+
+    # rich puts a blank line between the elements of one Markdown, except
+    # after a horizontal rule and before the elements that start with one of
+    # their own. Blocks printed on their own are spaced the same way.
+    def _print_block(self, console, block):
+        markdown = Markdown(block)
+        if self._separate and markdown.parsed and markdown.parsed[0].type not in spaced_elements:
+            console.print()
+        console.print(markdown)
+        self._separate = bool(markdown.parsed) and markdown.parsed[-1].type != "hr"
+
+    def __exit__(self, *exc_info):
+        with metrics.stage("render"):
+            self._live.stop()
+            if self._markdown_stream.tail.strip():
+                self._print_block(self.printer.console, self._markdown_stream.tail)
+            if self.accumulator:
+                self.result = self.accumulator.result()
+                self.printer.print_links(self.result)
+
+
+# prints the records of a json answer as json lines while they arrive instead
+# of rendering markdown, or writes them to a JsonlSink. Records that do not
+# match the schema are reported right away.
+class StructuredOutput:
+    def __init__(self, printer, schema, sink=None) -> None:
+        import structured
+        self.printer = printer
+        self.sink = sink
+        self.stream = structured.StructuredStream(schema)
+        self.accumulator = None
+        self.result = {}
+        self._reported = 0
+
+    def __enter__(self):
+        return self
+
+    def add(self, delta):
+        with metrics.stage("render"):
+            self.accumulator = self.accumulator or ResponseAccumulator()
+            self.accumulator.add(delta)
+            for record in self.stream.feed(delta["text"]):
+                self.write(record)
+            for error in self.stream.errors[self._reported:]:
+                self.printer.console.print(error, style="#ff4400", markup=False, emoji=False, highlight=False)
+            self._reported = len(self.stream.errors)
+
+    def write(self, record):
+        if self.sink:
+            self.sink.write(record)
+        else:
+            self.printer.console.print(json.dumps(record, ensure_ascii=False), markup=False, emoji=False, highlight=False, soft_wrap=True)
+
+    def __exit__(self, *exc_info):
+        import structured
+        if not self.accumulator:
+            return
+        self.result = self.accumulator.result()
+        try:
+            self.result["value"] = value = self.stream.finish()
+        except structured.SchemaError as e:
+            if not self.stream.errors:
+                self.printer.console.print(str(e), style="#ff4400", markup=False, emoji=False, highlight=False)
+            return
+        # a scalar answer has no records
+        if not self.stream.records and not isinstance(value, list):
+            self.write(value)
+
+
+class RichPrinter:
+    def __init__(self, stream=True, refresh_per_second=8) -> None:
+        self.console = Console()
+        self.stream = stream
+        self.refresh_per_second = refresh_per_second
+
+
+    def open_output(self):
+        return StreamingOutput(self) if self.stream else ProgressOutput(self)
+
+
+    def render(self, deltas, output=None):
+        with output or self.open_output() as output:
+            for delta in deltas:
+                output.add(delta)
+        return output.result
+
+
+    async def render_async(self, deltas, output=None):
+        with output or self.open_output() as output:
+            async for delta in deltas:
+                output.add(delta)
+        return output.result
+
+
+    def print_result(self, result):
+        self.console.print(Markdown(result["model_output"]))
+        self.print_links(result)
+
+
+    # the answers of a comparison side by side, while streaming only the last
+    # lines of each answer that fit on the screen are shown
+    def make_comparison_view(self, comparison, streaming):
+        from rich.panel import Panel
+        from rich.table import Table
+        from rich.text import Text
+        grid = Table.grid(expand=True, padding=(0, 1))
+        width = max(10, self.console.width // len(comparison.candidates) - 5)
+        rows = max(3, self.console.height - 8)
+        panels = []
+        for candidate in comparison.candidates:
+            if streaming:
+                lines = Text(candidate.text[-rows * width:]).wrap(self.console, width)
+                body = Text("\n").join(lines[-rows:])
+            else:
+                body = Markdown(candidate.text) if candidate.text else Text(candidate.error or "", style="#ff4400")
+            grid.add_column(ratio=1)
+            panels.append(Panel(body, title=candidate.model_name, height=rows + 2 if streaming else None,
+                                border_style="#00ff44" if candidate.done else "#888888"))
+        grid.add_row(*panels)
+        grid.add_row(*[Text(f" {candidate.stats()}", style="#888888") for candidate in comparison.candidates])
+        return grid
+
+
+    async def render_comparison(self, comparison):
+        from rich.live import Live
+        with metrics.stage("render"):
+            live = Live(console=self.console, refresh_per_second=self.refresh_per_second, transient=True,
+                        get_renderable=lambda: self.make_comparison_view(comparison, streaming=True))
+        with live:
+            await comparison.run()
+        with metrics.stage("render"):
+            self.console.print(self.make_comparison_view(comparison, streaming=False))
+
+
+    # the answer of a background question in a panel labeled with its number
+    def print_job(self, job):
+        from rich.panel import Panel
+        from rich.text import Text
+        if job.error:
+            body = Text(f"failed: {job.error}", style="#ff4400")
+        else:
+            body = Markdown(job.result["model_output"])
+        subtitle = Text(f"{job.model}   :merge {job.number}" if job.result else f"{job.model or ''}")
+        self.console.print(Panel(body, title=Text(job.title), title_align="left", subtitle=subtitle, subtitle_align="right", border_style="#00ff44"))
+        if job.result:
+            self.print_links(job.result)
+
+
+    def print_links(self, result):
+        link_list = [f"[{link.web.title}]({link.web.uri}) " for link in result["grounding_chunks"]]
+        link_string = " ".join(link_list)
+        self.console.print(Markdown(link_string))
+
+        link_list = [f"[{entry.retrieved_url}]({entry.retrieved_url}) " for entry in result["url_metadata"]]
+        link_string = " ".join(link_list)
+        self.console.print(Markdown(link_string))
@@ -1,6 +1,12 @@
 ################################################################################
 #               https://ai.google.dev/gemini-api/docs                          #
 ################################################################################
+import sys
+import cli
+# a one-shot prompt for a running daemon is forwarded before the imports below
+if __name__ == "__main__" and cli.forward(cli.parse_args(sys.argv[1:])):
+    sys.exit()
+
 from prompt_toolkit import PromptSession
 from prompt_toolkit.key_binding import KeyBindings
 from prompt_toolkit.history import FileHistory
@@ -14,125 +20,36 @@ from rich.markdown import Markdown
 from typing import Optional
 from abc import ABC, abstractmethod
 import enum
-import sys
-import json, re
+import os
+import contextlib, cProfile
+import asyncio, signal
+import html
 import tempfile
-import gemini_search, filehandling
+import filehandling, blobstore, preprocess, daemon, metrics, background
+from llm import Llm, ResponseAccumulator
+from render import StructuredOutput, RichPrinter
+from json_records import StreamingJsonExtractor, JsonlSink
 
 help_str=r"""**Command Line LLM**  
-read youtube videos from url, pdf/image/video/audio from filepath or url  
+read youtube videos from url, pdf/image/video/audio from filepaths, directories, globs or urls  
 `<F2>`     Toggle Standard/Short/Custom Answer  
 `<F3>`     Toggle Google Search  
 `<F4>`     Toggle Url Context  
-`<F5>`     Toggle Gemini Models (pro, flash, flash_lite)  
+`<F5>`     Toggle Gemini Models (pro, flash, flash_lite, auto)  
+`<F6>`     Toggle Streaming Output  
+`<F7>`     Toggle Metrics of the last request  
+`<F8>`     Toggle Compare Mode (pro, flash and lite answer side by side)  
 `<Ctrl-q>` Clear Chat History  
 `<Ctrl-d>` Exit (or type exit)  
-`\`        Enter custom system instruction
+`\`        Enter custom system instruction  
+`@pro` `@flash` `@lite` at the start of a prompt: use this model once  
+`:save <name>` `:resume <name>` `:sessions` Save, resume and list sessions  
+`& <prompt>` Ask in the background on a copy of the history, `&& <prompt>` without history  
+`:jobs` `:merge <n>` List background questions, add answer n to the history  
+`@all <prompt>` Compare once, `:pick <model>` Commit the answer of this model to the history
 """
 
 
-class Llm:
-    def __init__(self) -> None:
-        self.gemini = gemini_search.GeminiSearch()
-        self._current_model_index = 1
-        self._current_instruction_index = 0
-        self._instruction_list = [{"name":"std", "instruction":''},
-                            {"name":"short", "instruction":'answer short and precise, do not explain, just answer the question. If the prompt starts with "exp", give a detailed answer with explanation.'},
-                            {"name":"custom", "instruction":''}]
-
-    @property
-    def active_instruction(self):
-        return self._instruction_list[self._current_instruction_index]
-
-    def activate_next_instruction(self):
-        self._current_instruction_index = (self._current_instruction_index + 1) % len(self._instruction_list)
-        self.gemini.system_instruction = self.active_instruction["instruction"]
-        return self.active_instruction
-
-    def set_custom_instruction(self, text):
-        self._instruction_list[2]["instruction"] = text
-        self._current_instruction_index = 2
-        self.gemini.system_instruction = self.active_instruction["instruction"]
-
-    def activate_next_model(self):
-        self._current_model_index = (self._current_model_index + 1) % len(self.gemini.known_models)
-        self.gemini.model = self.gemini.known_models[self._current_model_index]()
-
-
-    @property
-    def use_url_context_tool(self):
-        return self.gemini.tools_state["url_context"]
-
-    @use_url_context_tool.setter
-    def use_url_context_tool(self, value):
-        self.gemini.tools_state["url_context"] = value
-
-
-    @property
-    def use_google_search_tool(self):
-        return self.gemini.tools_state["google_search"]
-
-    @use_google_search_tool.setter
-    def use_google_search_tool(self, value):
-        self.gemini.tools_state["google_search"] = value
-
-
-    def has_history(self):
-        return self.gemini.contents != []
-
-
-    def clear_history(self):
-        self.gemini.clear_contents()
-
-
-    def ask_llm(self, prompt):
-        model_output = ""
-        grounding_chunks = []
-        url_metadata = []
-        parts = []
-        for chunk in self.gemini.generate_stream(prompt):
-            if type(chunk.text)==str:
-                model_output += chunk.text
-
-            if self.gemini.tools_state['google_search']:
-                if chunk.candidates and chunk.candidates[0].grounding_metadata and chunk.candidates[0].grounding_metadata.grounding_chunks:
-                    grounding_chunks += chunk.candidates[0].grounding_metadata.grounding_chunks
-
-            if self.gemini.tools_state['url_context']:
-                if chunk.candidates and chunk.candidates[0].url_context_metadata and chunk.candidates[0].url_context_metadata.url_metadata:
-                    url_metadata += chunk.candidates[0].url_context_metadata.url_metadata
-
-            if chunk.candidates:
-                for candidate in chunk.candidates:
-                    if candidate.content.parts:
-                        for part in candidate.content.parts:
-                            parts.append(part)
-
-            yield {
-                "model_output":model_output,
-                "grounding_chunks":grounding_chunks,
-                "url_metadata":url_metadata,
-                "parts":parts,
-                }
-
-
-class RichPrinter:
-    def __init__(self) -> None:
-        self.console = Console()
-
-
-    def print_result(self, result):
-        self.console.print(Markdown(result["model_output"]))
-
-        link_list = [f"[{link.web.title}]({link.web.uri}) " for link in result["grounding_chunks"]]
-        link_string = " ".join(link_list)
-        self.console.print(Markdown(link_string))
-
-        link_list = [f"[{entry.retrieved_url}]({entry.retrieved_url}) " for entry in result["url_metadata"]]
-        link_string = " ".join(link_list)
-        self.console.print(Markdown(link_string))
-
-
 class View:
     def __init__(self, llm: Llm) -> None:
         self.llm = llm
@@ -144,6 +61,11 @@ class View:
         self.kb = KeyBindings()
 
         self.printer = RichPrinter()
+        self.show_metrics = False
+        # background.JobManager of the running repl
+        self.jobs = None
+        # every prompt goes to all models, see compare.py
+        self.compare_mode = False
 
     def register_keybindings(self):
         @self.kb.add("c-q")
@@ -167,6 +89,18 @@ class View:
         def _(event):
             self.llm.activate_next_model()
 
+        @self.kb.add("f6")
+        def _(event):
+            self.printer.stream = not self.printer.stream
+
+        @self.kb.add("f7")
+        def _(event):
+            self.show_metrics = not self.show_metrics
+
+        @self.kb.add("f8")
+        def _(event):
+            self.compare_mode = not self.compare_mode
+
 
     def get_user_input(self):
         prompt = self.session.prompt(f'prompt> ',
@@ -175,14 +109,63 @@ class View:
                                      completer=self.completer,
                                      complete_while_typing=True,
                                      bottom_toolbar=self.make_bottom_toolbar,
+                                     refresh_interval=0.5,
                                      )
         return prompt
 
 
+    async def get_user_input_async(self):
+        prompt = await self.session.prompt_async(f'prompt> ',
+                                     style=Style.from_dict({'bottom-toolbar': "#1C2B16 bg:#00ff44"}),
+                                     key_bindings=self.kb,
+                                     completer=self.completer,
+                                     complete_while_typing=True,
+                                     bottom_toolbar=self.make_bottom_toolbar,
+                                     refresh_interval=0.5,
+                                     )
+        return prompt
+
+
+    def make_context_size(self):
+        history = self.llm.gemini.history
+        compacting = "*" if history.compacting else ""
+        return f"ctx {history.context_tokens / 1000:.1f}k/{history.budget_tokens / 1000:.0f}k{compacting}"
+
+
+    def make_attachment_status(self):
+        pending, failed, total = self.llm.gemini.pending_attachment_counts()
+        if not total:
+            return ""
+        status = f"   files {total - pending}/{total}" if pending else f"   files {total - failed} ready"
+        return status + (f" {failed} rejected" if failed else "")
+
+
+    def make_jobs_status(self):
+        if not self.jobs or not self.jobs.jobs:
+            return ""
+        running = len(self.jobs.running)
+        to_merge = sum(1 for job in self.jobs.jobs.values() if job.done and job.result and not job.merged)
+        status = [f"{running} running"] if running else []
+        status += [f"{to_merge} to merge"] if to_merge else []
+        return f"   bg {' '.join(status)}" if status else ""
+
+
+    def make_model_name(self):
+        if self.compare_mode:
+            return "compare"
+        if self.llm.auto_route:
+            return f"auto:{self.llm.gemini.model.short_name}"
+        return self.llm.gemini.model.short_name
+
+
     def make_bottom_toolbar(self):
         answer = self.llm.active_instruction["name"].ljust(6, " ")
-        toolbar_string = f'  {answer}   {"google   " if self.llm.use_google_search_tool else "no google"}   {"url context   "  if self.llm.use_url_context_tool else "no url context"}   {"has history  " if self.llm.has_history() else "chat is empty"}    {self.llm.gemini.model.short_name}\n'
-        toolbar_string += '<style bg="#aaaaaa">  F2       F3          F4               Ctrl-q           F5</style>'
+        if not self.llm.gemini_ready():
+            return HTML(f'  {answer}   loading gemini ...\n')
+        toolbar_string = f'  {answer}   {"google   " if self.llm.use_google_search_tool else "no google"}   {"url context   "  if self.llm.use_url_context_tool else "no url context"}   {"has history  " if self.llm.has_history() else "chat is empty"}    {self.make_model_name().ljust(5, " ")}   {"stream   " if self.printer.stream else "no stream"}   {self.make_context_size()}{self.make_attachment_status()}{self.make_jobs_status()}\n'
+        toolbar_string += '<style bg="#aaaaaa">  F2       F3          F4               Ctrl-q           F5      F6</style>'
+        if self.show_metrics and metrics.last:
+            toolbar_string += f'\n  {html.escape(metrics.last.summary())}'
         return HTML(toolbar_string)
 
 
@@ -219,6 +202,18 @@ class PromptHandler(ABC):
                 return Continuation.UNHANDLED
 
 
+    async def handle_async(self, prompt) -> Continuation:
+        responsible = self._check_responsibility(prompt)
+        if responsible:
+            await self._execute_async(prompt)
+            return self._continuation()
+        else:
+            if self.successor:
+                return await self.successor.handle_async(prompt)
+            else:
+                return Continuation.UNHANDLED
+
+
     @abstractmethod
     def _check_responsibility(self, prompt: str) -> bool:
         pass
@@ -227,6 +222,9 @@ class PromptHandler(ABC):
     def _execute(self, prompt: str):
         ...
 
+    async def _execute_async(self, prompt: str):
+        self._execute(prompt)
+
 
 class BreakHandler(PromptHandler):
     def __init__(self, successor) -> None:
@@ -272,6 +270,84 @@ class ExitHandler(BreakHandler):
         pass
 
 
+class SessionHandler(ContinueHandler):
+    def __init__(self, llm, view, successor: Optional[PromptHandler] = None) -> None:
+        super().__init__(successor)
+        self.llm = llm
+        self.view = view
+        self._session_store = None
+
+    @property
+    def session_store(self):
+        if self._session_store is None:
+            import sessions
+            self._session_store = sessions.SessionStore()
+        return self._session_store
+
+    def _check_responsibility(self, prompt: str) -> bool:
+        return prompt.strip().split(" ")[0] in (":save", ":resume", ":sessions")
+
+    def _execute(self, prompt: str):
+        command, _, name = prompt.strip().partition(" ")
+        name = name.strip()
+        try:
+            if command == ":sessions":
+                self.view.printer.console.print(" ".join(self.session_store.list()) or "no saved sessions")
+            elif command == ":save":
+                self.session_store.save(name, self.llm.gemini)
+                self.view.printer.console.print(f"[#00ff44]session saved as {name}[/#00ff44]")
+            elif command == ":resume":
+                self.session_store.load(name, self.llm.gemini)
+                self.llm.sync_selection()
+                self.view.printer.console.print(f"[#00ff44]session {name} resumed with {len(self.llm.gemini.contents)} entries[/#00ff44]")
+        except (OSError, ValueError) as e:
+            self.view.printer.console.print(f"[#ff4400]{command} failed:[/#ff4400] {e}")
+
+
+# "& prompt" and "&& prompt" ask in the background, ":jobs" lists the
+# background questions and ":merge N" adds an answer to the main history
+class BackgroundHandler(ContinueHandler):
+    def __init__(self, llm, view, jobs, successor: Optional[PromptHandler] = None) -> None:
+        super().__init__(successor)
+        self.llm = llm
+        self.view = view
+        self.jobs = jobs
+
+    def _check_responsibility(self, prompt: str) -> bool:
+        return prompt.strip().startswith("&") or prompt.strip().split(" ")[0] in (":jobs", ":merge")
+
+    def _execute(self, prompt: str):
+        console = self.view.printer.console
+        command, _, argument = prompt.strip().partition(" ")
+        if command == ":jobs":
+            for job in self.jobs.jobs.values():
+                console.print(f"{job.title}   {job.status()}", highlight=False, markup=False)
+            if not self.jobs.jobs:
+                console.print("no background questions")
+        elif command == ":merge":
+            try:
+                if not argument.strip().isdigit():
+                    raise ValueError("usage: :merge <number>")
+                job = self.jobs.merge(int(argument), self.llm.gemini)
+                console.print(f"[#00ff44]\\[{job.number}] merged into the history[/#00ff44]")
+            except ValueError as e:
+                console.print(f"[#ff4400]:merge failed:[/#ff4400] {e}", highlight=False)
+        else:
+            console.print(f"[#ff4400]background questions need the interactive repl[/#ff4400]")
+
+    async def _execute_async(self, prompt: str):
+        prompt = prompt.strip()
+        if not prompt.startswith("&"):
+            self._execute(prompt)
+            return
+        with_history = not prompt.startswith("&&")
+        if not (question := prompt.lstrip("&").strip()):
+            self.view.printer.console.print(f"[#ff4400]{'&' if with_history else '&&'} needs a prompt[/#ff4400]")
+            return
+        job = self.jobs.start(question, with_history)
+        self.view.printer.console.print(f"[#888888]\\[{job.number}] asked in the background {'on a copy of the history' if with_history else 'without history'}[/#888888]")
+
+
 class SystemInstructionHandler(ContinueHandler):
     def __init__(self, llm, view, successor: Optional[PromptHandler] = None) -> None:
         super().__init__(successor)
@@ -307,50 +383,145 @@ class YoutubeUrlHandler(ContinueHandler):
 
 
 class FileHandler(ContinueHandler):
-    def __init__(self, llm, view, file_loader: filehandling.FileLoader, successor: Optional[PromptHandler] = None) -> None:
+    def __init__(self, llm, view, make_local_loader, make_url_loader, preprocessor=None, successor: Optional[PromptHandler] = None) -> None:
         super().__init__(successor)
         self.llm = llm
         self.view = view
-        self.file_loader = file_loader
+        self.make_local_loader = make_local_loader
+        self.make_url_loader = make_url_loader
+        self.preprocessor = preprocessor
+        self._attachments = None
 
     def _check_responsibility(self, prompt: str) -> bool:
-        file_data = self.file_loader.validate(prompt)
-        return True if file_data else False
+        import attachments
+        self._attachments = attachments.expand(prompt, self.make_local_loader, self.make_url_loader)
+        return self._attachments is not None
 
     def _execute(self, prompt: str):
-        file_name = self.file_loader.validate(prompt)
-        mimetype = self.file_loader.get_mimetype(file_name)
-        if mimetype not in gemini_search.allowed_mimetypes:
-            self.view.printer.console.print(f"[#ff4400]file rejected, it has non allowed mimetype:[/#ff4400] {mimetype}")
-        else:
-            bin_data = self.file_loader.load(file_name)
-            self.view.printer.console.print(f"[#00ff44]file accepted[/#00ff44]")
-            self.llm.gemini.add_file_to_content(bin_data, mimetype)
+        import gemini_search, attachments
+        from rich.progress import Progress
+        console = self.view.printer.console
+        if not self._attachments:
+            console.print(f"[#ff4400]no files found[/#ff4400]")
+            return
+
+        loader = attachments.AttachmentLoader(self.llm.gemini, gemini_search.allowed_mimetypes, self.preprocessor)
+        with Progress(console=console, transient=True) as progress:
+            task = progress.add_task("loading files", total=None)
+            parts, rejected = loader.run(self._attachments, lambda done, total: progress.update(task, completed=done, total=total))
+
+        if parts:
+            self.llm.gemini.add_parts_to_content(parts)
+        self.report(parts, rejected)
+
+    def report(self, parts, rejected):
+        console = self.view.printer.console
+        if parts:
+            console.print(f"[#00ff44]{len(parts)} {'file' if len(parts) == 1 else 'files'} accepted[/#00ff44]")
+        if rejected:
+            console.print(f"[#ff4400]{len(rejected)} {'file' if len(rejected) == 1 else 'files'} rejected:[/#ff4400]")
+            for attachment in rejected:
+                console.print(f"  {attachment.name}: {attachment.error}", highlight=False)
+
+    # the repl does not wait for the files, they load while the question is
+    # typed and the next request waits for whatever is still missing
+    async def _execute_async(self, prompt: str):
+        import gemini_search, attachments
+        from prompt_toolkit.application import run_in_terminal
+        if not self._attachments:
+            self.view.printer.console.print(f"[#ff4400]no files found[/#ff4400]")
+            return
+
+        loop = asyncio.get_running_loop()
+        def on_done(parts, rejected):
+            # printed above the prompt the user is typing in
+            loop.call_soon_threadsafe(run_in_terminal, lambda: self.report(parts, rejected))
+
+        loader = attachments.AttachmentLoader(self.llm.gemini, gemini_search.allowed_mimetypes, self.preprocessor)
+        if pending_parts := loader.start(self._attachments, on_done):
+            self.llm.gemini.add_pending_parts_to_content(pending_parts)
+            self.view.printer.console.print(f"[#00ff44]loading {len(pending_parts)} {'file' if len(pending_parts) == 1 else 'files'} ...[/#00ff44]")
+
+
+# "@all prompt", or any prompt in compare mode, is answered by all models at
+# once, ":pick <model>" commits one of the answers to the history
+class CompareHandler(ContinueHandler):
+    def __init__(self, llm, view, successor: Optional[PromptHandler] = None) -> None:
+        super().__init__(successor)
+        self.llm = llm
+        self.view = view
+        self.comparison = None
 
+    def _check_responsibility(self, prompt: str) -> bool:
+        command = prompt.strip().split(" ")[0]
+        return command in ("@all", ":pick") or self.view.compare_mode
 
+    def _execute(self, prompt: str):
+        console = self.view.printer.console
+        command, _, argument = prompt.strip().partition(" ")
+        if command != ":pick":
+            console.print(f"[#ff4400]comparing models needs the interactive repl[/#ff4400]")
+            return
+        try:
+            if not self.comparison:
+                raise ValueError("there is no comparison to pick from")
+            candidate = self.comparison.pick(argument.strip(), self.llm.gemini)
+            console.print(f"[#00ff44]answer of {candidate.model_name} added to the history[/#00ff44]")
+        except ValueError as e:
+            console.print(f"[#ff4400]:pick failed:[/#ff4400] {e}", highlight=False)
+
+    async def _execute_async(self, prompt: str):
+        import compare
+        command, _, argument = prompt.strip().partition(" ")
+        if command == ":pick":
+            self._execute(prompt)
+            return
+        if command == "@all":
+            prompt = argument
+        model_names = [model().short_name for model in self.llm.gemini.known_models]
+        self.comparison = compare.Comparison(self.llm, prompt, model_names, ResponseAccumulator)
+        await self.view.printer.render_comparison(self.comparison)
+        if any(candidate.result for candidate in self.comparison.candidates):
+            self.view.printer.console.print(f"[#888888]:pick {'|'.join(model_names)} adds one of the answers to the history[/#888888]")
+
+
+# answers with the model. With a json_sink the records of ```json blocks are
+# written while the answer streams, with a schema the answer is json and
+# its records are printed or written instead of rendered as markdown.
 class DefaultHandler(ContinueHandler):
-    def __init__(self, llm, view, successor: Optional[PromptHandler] = None) -> None:
+    def __init__(self, llm, view, successor: Optional[PromptHandler] = None, json_sink=None) -> None:
         super().__init__(successor)
         self.llm = llm
         self.view = view
+        self.json_sink = json_sink
 
     def _check_responsibility(self, prompt: str) -> bool:
         return True
 
     def _execute(self, prompt):
-        num_dots = 0
-        result = {}
-        for result in self.llm.ask_llm(prompt):
-            self.view.printer.console.print("\r[#00ff00]" + "-", end="")
-            num_dots += 1
-
-        self.view.printer.console.print("\r[#00ff00]" + "-" * (self.view.printer.console.width - num_dots) + "[/#00ff00]")
-
+        written = self.json_sink.count if self.json_sink else 0
+        deltas, output = self.llm.ask_llm(prompt), self.make_output()
+        if self.json_sink and not output:
+            deltas = StreamingJsonExtractor().follow(deltas, self.json_sink.write)
+        self.finish(self.view.printer.render(deltas, output), written)
+
+    async def _execute_async(self, prompt):
+        written = self.json_sink.count if self.json_sink else 0
+        deltas, output = self.llm.ask_llm_async(prompt), self.make_output()
+        if self.json_sink and not output:
+            deltas = StreamingJsonExtractor().afollow(deltas, self.json_sink.write)
+        self.finish(await self.view.printer.render_async(deltas, output), written)
+
+    def make_output(self):
+        if self.llm.gemini.schema:
+            return StructuredOutput(self.view.printer, self.llm.gemini.schema, self.json_sink)
+        return None
+
+    def finish(self, result, written):
         if result:
-            self.view.printer.print_result(result)
             self.llm.gemini.add_content(role="model", text=result["model_output"])
-            embedded_json_dicts = JsonExtractor().extract(result["model_output"])
-            print(embedded_json_dicts)
+        if self.json_sink and self.json_sink.count > written:
+            self.view.printer.console.print(f"[#888888]{self.json_sink.count - written} json records written to {self.json_sink.path}[/#888888]")
 
 #  ____  _____ ____  _
 # |  _ \| ____|  _ \| |
@@ -358,51 +529,108 @@ class DefaultHandler(ContinueHandler):
 # |  _ <| |___|  __/| |___
 # |_| \_\_____|_|   |_____|
 class ReplController:
-    def __init__(self):
-        self.llm = Llm()
+    def __init__(self, profile=False, preprocess=True, json_out=None, **llm_settings):
+        self.llm = Llm(**llm_settings)
         self.view = View(self.llm)
         self.view.register_keybindings()
+        self.profile = profile
+        self.preprocess = preprocess
+        self.json_sink = JsonlSink(json_out) if json_out else None
+        self._num_turns = 0
+
+
+    # measures a turn for the metrics log and with --profile dumps a cProfile of it
+    @contextlib.contextmanager
+    def instrumented_turn(self, kind):
+        self._num_turns += 1
+        metrics.begin(kind)
+        profiler = cProfile.Profile() if self.profile else None
+        if profiler:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler:
+                profiler.disable()
+            request_metrics = metrics.end()
+            if profiler and request_metrics and request_metrics is metrics.last:
+                profile_path = f"{tempfile.gettempdir()}/llm-turn-{os.getpid()}-{self._num_turns}.prof"
+                profiler.dump_stats(profile_path)
+                self.view.printer.console.print(f"[#888888]profile written to {profile_path}[/#888888]")
 
 
     def process_prompt(self, prompt):
-        num_dots = 0
-        result = {}
-        for result in self.llm.ask_llm(prompt):
-            self.view.printer.console.print("\r[#00ff00]" + "-", end="")
-            num_dots += 1
+        DefaultHandler(self.llm, self.view, json_sink=self.json_sink).handle(prompt)
 
-        self.view.printer.console.print("\r[#00ff00]" + "-" * (self.view.printer.console.width - num_dots) + "[/#00ff00]")
 
-        if result:
+    def run_once(self, prompt):
+        with self.instrumented_turn("once"):
+            deltas = self.llm.ask_llm(prompt)
+            if self.llm.gemini.schema:
+                self.view.printer.render(deltas, StructuredOutput(self.view.printer, self.llm.gemini.schema, self.json_sink))
+                return
+            if self.json_sink:
+                deltas = StreamingJsonExtractor().follow(deltas, self.json_sink.write)
+            result = ResponseAccumulator.collect(deltas)
             self.view.printer.print_result(result)
-            self.llm.gemini.add_content(role="model", text=result["model_output"])
-            embedded_json_dicts = JsonExtractor().extract(result["model_output"])
-            print(embedded_json_dicts)
 
 
-    def run_once(self, prompt):
-        result = {}
-        for result in self.llm.ask_llm(prompt):
-            pass
-        self.view.printer.print_result(result)
+    def run(self):
+        asyncio.run(self.run_async())
 
 
-    def run(self):
+    # printed above the prompt, or below the answer that is being streamed
+    def show_job(self, job):
+        from prompt_toolkit.application import run_in_terminal
+        run_in_terminal(lambda: self.view.printer.print_job(job))
+
+
+    async def _handle_turn(self, handler, prompt):
+        # Ctrl-c while an answer is generated cancels the turn, not the repl
+        loop = asyncio.get_running_loop()
+        with self.instrumented_turn("turn"):
+            turn = asyncio.ensure_future(handler.handle_async(prompt))
+            try:
+                loop.add_signal_handler(signal.SIGINT, turn.cancel)
+            except (NotImplementedError, RuntimeError):
+                pass
+            try:
+                return await turn
+            except asyncio.CancelledError:
+                if not turn.cancelled():
+                    raise
+                return Continuation.CONTINUE
+            finally:
+                try:
+                    loop.remove_signal_handler(signal.SIGINT)
+                except (NotImplementedError, RuntimeError):
+                    pass
+
+
+    async def run_async(self):
         self.view.printer.console.print(Markdown(help_str))
 
-        h_llm = DefaultHandler(self.llm, self.view)
-        h_url_files = FileHandler(self.llm, self.view, filehandling.UrlFileLoader(), h_llm)
-        h_local_files = FileHandler(self.llm, self.view, filehandling.LocalFileLoader(), h_url_files)
-        h_youtube_url = YoutubeUrlHandler(self.llm, self.view, h_local_files)
+        file_cache = blobstore.BlobStore()
+        preprocessor = preprocess.Preprocessor(file_cache, shrink=self.preprocess)
+        h_llm = DefaultHandler(self.llm, self.view, json_sink=self.json_sink)
+        h_compare = CompareHandler(self.llm, self.view, h_llm)
+        h_files = FileHandler(self.llm, self.view,
+                              lambda: filehandling.CachingFileLoader(filehandling.LocalFileLoader(), file_cache),
+                              lambda: filehandling.CachingFileLoader(filehandling.UrlFileLoader(), file_cache), preprocessor, h_compare)
+        h_youtube_url = YoutubeUrlHandler(self.llm, self.view, h_files)
         h_instruction = SystemInstructionHandler(self.llm, self.view, h_youtube_url)
-        h_empty = EmptyPromptHandler(h_instruction)
+        jobs = background.JobManager(self.llm, ResponseAccumulator, on_done=self.show_job)
+        self.view.jobs = jobs
+        h_background = BackgroundHandler(self.llm, self.view, jobs, h_instruction)
+        h_session = SessionHandler(self.llm, self.view, h_background)
+        h_empty = EmptyPromptHandler(h_session)
         h_exit = ExitHandler(h_empty)
 
         while True:
             try:
-                prompt = self.view.get_user_input()
+                prompt = await self.view.get_user_input_async()
 
-                continuation = h_exit.handle(prompt)
+                continuation = await self._handle_turn(h_exit, prompt)
                 if continuation == Continuation.BREAK:
                     break
                 elif continuation == Continuation.CONTINUE:
@@ -416,33 +644,46 @@ class ReplController:
             except (EOFError):
                 break
 
+        jobs.cancel_all()
+        preprocessor.shutdown()
 
-class JsonExtractor:
-    def __init__(self) -> None:
-        pass
-
-    def extract(self, text):
-        json_strings = re.findall(r"(?<=```json).*?(?=```)", text, flags=re.MULTILINE| re.DOTALL)
-        result = []
-        for json_string in json_strings:
-            tmp_result = []
-            try:
-                tmp_result = json.loads(json_string)
-            except (json.JSONDecodeError, TypeError) as e:
-                print(f"Error: Could not decode json_string: {json_string}\n", e)
-            if tmp_result:
-                result += tmp_result
-
-                return result
 
 def main(argv):
-    controller = ReplController()
-    if len(argv) == 1:
-        controller.run()
-    else:
-        _, *prompt = argv
-        prompt = " ".join(prompt)
-        controller.run_once(prompt)
+    args = cli.parse_args(argv[1:])
+    if args.serve:
+        daemon.serve()
+        return
+
+    schema = None
+    if args.schema:
+        import structured
+        try:
+            schema = structured.load(args.schema)
+        except structured.SchemaError as e:
+            Console().print(str(e), style="#ff4400", markup=False, emoji=False, highlight=False)
+            sys.exit(2)
+
+    if args.batch:
+        import batch
+        batch.BatchRunner(workers=args.workers, rpm=args.rpm, default_model=args.model, cache_responses=args.cache_responses, default_schema=args.schema,
+                           hedge_after=args.hedge, deadline=args.deadline).run_files(args.batch, args.output)
+        return
+
+    controller = ReplController(profile=args.profile, preprocess=not args.no_preprocess, json_out=args.json_out, model=args.model, schema=schema, context_budget=args.context_budget, cache_responses=args.cache_responses,
+                                hedge_after=args.hedge, deadline=args.deadline)
+    if args.resume:
+        import sessions
+        sessions.SessionStore().load(args.resume, controller.llm.gemini)
+        controller.llm.sync_selection()
+    try:
+        if not args.prompt:
+            controller.run()
+        else:
+            prompt = " ".join(args.prompt)
+            controller.run_once(prompt)
+    finally:
+        if controller.json_sink:
+            controller.json_sink.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,57 @@
+import re
+import time
+import random
+import httpx
+from google.genai.errors import APIError
+
+
+retryable_codes = (408, 429, 500, 502, 503, 504)
+
+
+# when and how long to wait before a failed request is sent again: exponential
+# backoff with full jitter, at least as long as the server asks for, and never
+# past the deadline of the turn. The deadline bounds the time until the answer
+# starts streaming, a long answer that is already being shown is not cut off.
+# With hedge_after_s a slow pro request is raced against flash.
+class RetryPolicy:
+    def __init__(self, attempts=4, base_delay_s=1.0, max_delay_s=20.0, deadline_s=120.0, hedge_after_s=None) -> None:
+        self.attempts = attempts
+        self.base_delay_s = base_delay_s
+        self.max_delay_s = max_delay_s
+        self.deadline_s = deadline_s
+        self.hedge_after_s = hedge_after_s
+
+    def is_retryable(self, error):
+        if isinstance(error, APIError):
+            return error.code in retryable_codes
+        return isinstance(error, httpx.TransportError)
+
+    # the Retry-After header or the RetryInfo detail of a google.rpc error
+    @staticmethod
+    def requested_delay(error):
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None) or {}
+        try:
+            return float(headers.get("retry-after"))
+        except (TypeError, ValueError):
+            pass
+        details = getattr(error, "details", None)
+        if isinstance(details, dict):
+            for detail in details.get("error", {}).get("details", []):
+                if isinstance(detail, dict) and (match := re.fullmatch(r"([\d.]+)s", str(detail.get("retryDelay", "")))):
+                    return float(match.group(1))
+        return None
+
+    def remaining(self, started):
+        return self.deadline_s - (time.monotonic() - started)
+
+    # seconds to wait before the next attempt, None to give up
+    def next_delay(self, attempt, error, started):
+        if attempt + 1 >= self.attempts or not self.is_retryable(error):
+            return None
+        delay = random.uniform(0, min(self.max_delay_s, self.base_delay_s * 2 ** attempt))
+        if (requested := self.requested_delay(error)) is not None:
+            delay = requested + random.uniform(0, self.base_delay_s)
+        if delay >= self.remaining(started):
+            return None
+        return delay
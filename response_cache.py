@@ -0,0 +1,91 @@
+import os, time, threading
+import weakref
+import gzip, hashlib, json, tempfile
+from google.genai import types
+
+
+# replays the chunk stream of earlier requests. The key covers model, config
+# (thinking budget, system instruction, tools) and the full contents, inline
+# attachments enter the key as sha256 digests. Entries expire after ttl_seconds,
+# the oldest are evicted beyond max_size_mb.
+class ResponseCache:
+    def __init__(self, directory=None, ttl_seconds=7 * 24 * 3600, max_size_mb=256) -> None:
+        self.directory = directory if directory else f"{tempfile.gettempdir()}/.llm-responses"
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size_mb * 1024 * 1024
+        # digests of inline data, keyed by id() of the blob. Only a weak
+        # reference is kept, the entry goes away with the attachment.
+        self._digests = {}
+
+    def _digest(self, blob):
+        if (entry := self._digests.get(id(blob))) and entry[0]() is blob:
+            return entry[1]
+        digest = hashlib.sha256(blob.data).hexdigest()
+        key = id(blob)
+        self._digests[key] = (weakref.ref(blob, lambda _, digests=self._digests: digests.pop(key, None)), digest)
+        return digest
+
+    def _serialize_content(self, content):
+        parts = []
+        for part in content.parts or []:
+            if part.inline_data:
+                parts.append({"inline_data": {"mime_type": part.inline_data.mime_type, "sha256": self._digest(part.inline_data)}})
+            else:
+                parts.append(part.model_dump(mode="json", exclude_none=True))
+        return {"role": content.role, "parts": parts}
+
+    def make_key(self, request):
+        key_data = {
+            "model": request["model"],
+            "config": request["config"].model_dump(mode="json", exclude_none=True),
+            "contents": [self._serialize_content(content) for content in request["contents"]],
+        }
+        return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+    def _path(self, key):
+        return f"{self.directory}/{key}.json.gz"
+
+    def get(self, key):
+        try:
+            if os.path.getmtime(self._path(key)) + self.ttl_seconds < time.time():
+                os.remove(self._path(key))
+                return None
+            with gzip.open(self._path(key), "rt") as f:
+                chunks = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return [types.GenerateContentResponse.model_validate_json(chunk) for chunk in chunks]
+
+    def put(self, key, chunks):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, "wt") as f:
+            json.dump([chunk.model_dump_json(exclude_none=True) for chunk in chunks], f)
+        os.replace(tmp_path, self._path(key))
+        self._evict()
+
+    def _evict(self):
+        now = time.time()
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".json.gz"):
+                continue
+            try:
+                stat = entry.stat()
+                if stat.st_mtime + self.ttl_seconds < now:
+                    os.remove(entry.path)
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            except OSError:
+                # removed by a concurrent eviction
+                pass
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,205 @@
+################################################################################
+#  auto routing: picks the cheapest model and thinking budget that is likely   #
+#  good enough for a request, from cheap local signals and a ledger of how     #
+#  earlier requests of the same kind went                                      #
+################################################################################
+import os, re, json, tempfile
+import threading
+from deferred import DeferredPart
+
+
+# ordered by cost and latency, a route is an index into this ladder
+ladder = (("lite", 0), ("flash", 0), ("flash", 1024), ("pro", 128))
+cost_rank = {"lite": 0, "flash": 1, "pro": 2}
+tiers = ("lookup", "standard", "reasoning", "complex")
+
+complexity_words = re.compile(r"\b(why|how does|explain|prove|derive|compare|analy[sz]e|design|implement|refactor|debug|optimi[sz]e|step by step|trade-?offs?|architecture|pros and cons)\b", re.IGNORECASE)
+heavy_mimetypes = ("video/", "audio/", "application/pdf")
+
+
+class Route:
+    def __init__(self, tier, rung, reasons) -> None:
+        self.tier = tier
+        self.rung = rung
+        self.reasons = reasons
+
+    @property
+    def model_name(self):
+        return ladder[self.rung][0]
+
+    @property
+    def thinking_budget(self):
+        return ladder[self.rung][1]
+
+    @property
+    def key(self):
+        return f"{self.tier}|{self.model_name}:{self.thinking_budget}"
+
+    def make_model(self, gemini):
+        model = gemini.find_model(self.model_name)
+        model.thinking_budget = self.thinking_budget
+        return model
+
+    def __str__(self):
+        return f"{self.model_name}:{self.thinking_budget} ({self.tier}: {', '.join(self.reasons)})"
+
+
+# moving averages per tier and ladder rung, persisted in the temp dir. An
+# escalation is a routed answer the user asked again with a bigger model.
+class Ledger:
+    def __init__(self, path=None, alpha=0.2) -> None:
+        self.path = path if path else f"{tempfile.gettempdir()}/.llm-ledger.json"
+        self.alpha = alpha
+        self._entries = None
+        self._lock = threading.Lock()
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            try:
+                with open(self.path) as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def stats(self, key):
+        return self.entries.get(key, {"n": 0, "ttft_s": None, "failure_rate": 0.0, "escalation_rate": 0.0, "skipped": 0})
+
+    def _update(self, key, **samples):
+        entry = dict(self.stats(key))
+        for name, value in samples.items():
+            entry[name] = value if entry[name] is None else entry[name] + self.alpha * (value - entry[name])
+        return entry
+
+    def record(self, route, ttft_s):
+        with self._lock:
+            samples = {"failure_rate": 1.0 if ttft_s is None else 0.0, "escalation_rate": 0.0}
+            if ttft_s is not None:
+                samples["ttft_s"] = ttft_s
+            entry = self._update(route.key, **samples)
+            entry["n"] += 1
+            entry["skipped"] = 0
+            self.entries[route.key] = entry
+            self._save()
+
+    def skip(self, route):
+        with self._lock:
+            entry = dict(self.stats(route.key))
+            entry["skipped"] = entry.get("skipped", 0) + 1
+            self.entries[route.key] = entry
+            self._save()
+
+    # counts as one more sample of the escalation rate
+    def escalate(self, route):
+        with self._lock:
+            entry = self._update(route.key, escalation_rate=1.0)
+            self.entries[route.key] = entry
+            self._save()
+
+    def _save(self):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass
+
+
+# the attachments of the prompt are the parts added since the last answer
+def pending_attachments(contents):
+    attachments = []
+    for content in reversed(contents):
+        if content.role == "model":
+            break
+        for part in content.parts or []:
+            if isinstance(part, DeferredPart):
+                attachments.append((part.mime_type, part.size))
+            elif part.inline_data:
+                attachments.append((part.inline_data.mime_type or "", len(part.inline_data.data or b"")))
+            elif part.file_data:
+                attachments.append((part.file_data.mime_type or "", None))
+    return attachments
+
+
+class Router:
+    def __init__(self, ledger=None, min_samples=3, max_escalation_rate=0.25, max_failure_rate=0.5, slow_ttft_s=20.0, probe_every=10) -> None:
+        self.ledger = ledger if ledger else Ledger()
+        self.min_samples = min_samples
+        self.probe_every = probe_every
+        self.max_escalation_rate = max_escalation_rate
+        self.max_failure_rate = max_failure_rate
+        self.slow_ttft_s = slow_ttft_s
+
+    def classify(self, gemini, prompt, short=False):
+        rung, reasons = 0, []
+        def at_least(minimum, reason):
+            nonlocal rung
+            if minimum > rung:
+                rung = minimum
+                reasons.append(reason)
+
+        # images and text are fine for lite
+        attachments = pending_attachments(gemini.contents)
+        if any(mime_type.startswith(heavy_mimetypes) for mime_type, _ in attachments):
+            at_least(1, "media or pdf")
+        if any(size and size > 20 * 1024 * 1024 for _, size in attachments):
+            at_least(2, "large attachment")
+        if len(prompt) > 400 or prompt.count("\n") > 2:
+            at_least(1, "long prompt")
+        if gemini.history.context_tokens > 32_000:
+            at_least(1, "long history")
+        if complexity_words.search(prompt):
+            at_least(2, "reasoning words")
+        if "```" in prompt or len(prompt) > 4000:
+            at_least(3, "code or very long prompt")
+        # the short instruction asks for bare answers, unless the prompt starts with "exp"
+        if short and not prompt.lower().startswith("exp") and rung > 0:
+            rung -= 1
+            reasons.append("short answer")
+        return Route(tiers[rung], rung, reasons or ["one-line lookup"])
+
+    # a rung that was skipped often enough is tried again, otherwise its
+    # stats could never recover
+    def usable(self, route):
+        stats = self.ledger.stats(route.key)
+        if stats["n"] < self.min_samples or stats.get("skipped", 0) >= self.probe_every:
+            return True
+        return stats["escalation_rate"] <= self.max_escalation_rate and stats["failure_rate"] <= self.max_failure_rate
+
+    def choose(self, gemini, prompt, short=False):
+        route = self.classify(gemini, prompt, short)
+        # move up while this kind of request was often escalated or failed on the rung
+        while route.rung < len(ladder) - 1 and not self.usable(route):
+            self.ledger.skip(route)
+            route = Route(route.tier, route.rung + 1, route.reasons + [f"ledger: {route.model_name}:{route.thinking_budget} not good enough"])
+        # a slow model is skipped for the next cheaper one, if that was good enough
+        ttft_s = self.ledger.stats(route.key)["ttft_s"]
+        if route.rung > 0 and ttft_s and ttft_s > self.slow_ttft_s:
+            cheaper = Route(route.tier, route.rung - 1, route.reasons + [f"ledger: {route.model_name} slow"])
+            if self.ledger.stats(cheaper.key)["n"] >= self.min_samples and self.usable(cheaper):
+                route = cheaper
+        return route
+
+    def record(self, route, ttft_s):
+        self.ledger.record(route, ttft_s)
+
+    def escalate(self, route):
+        self.ledger.escalate(route)
+
+
+def is_escalation(route, model_name):
+    return cost_rank[model_name] > cost_rank[route.model_name]
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared():
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = Router()
+        return _shared
@@ -0,0 +1,140 @@
+import os, re, time
+import gzip, json
+from functools import partial
+from google.genai import types
+from blobstore import BlobStore
+from deferred import DeferredPart, DeferredContent
+import filehandling
+
+
+# named conversations on disk. The record is a small gzipped json, inline
+# attachments are stored once in a content addressed blob directory and are
+# only read (or uploaded) again when the resumed session sends its next request.
+#
+# Files API uris expire after about two days, an uploaded file is saved with
+# its sha256 ("d") and where it can be uploaded again from: the path it was
+# uploaded from ("f"), or a copy in the blob directory taken from the file
+# cache. Without either only the uri is kept, e.g. for youtube links.
+#
+# record: {"version": 1, "model": "flash", "system_instruction": "...", "tools_state": {...},
+#          "contents": [{"r": "user", "p": [{"t": text} | {"b": sha256, "m": mime, "s": size}
+#                                           | {"u": uri, "m": mime, "d": sha256, "e": expires, "s": size, "f": path}
+#                                           | {"j": part as json}]}]}
+class SessionStore:
+    def __init__(self, directory=None, file_cache=None) -> None:
+        self.directory = directory if directory else os.path.expanduser("~/.asllm")
+        self.blobs = BlobStore(f"{self.directory}/blobs", max_size_mb=float("inf"))
+        # where loaded and preprocessed attachments are kept, see repl3.FileHandler
+        self.file_cache = file_cache if file_cache else BlobStore()
+
+    def session_path(self, name):
+        if not re.fullmatch(r"[\w.-]+", name):
+            raise ValueError(f"invalid session name: {name}")
+        return f"{self.directory}/sessions/{name}.json.gz"
+
+    def list(self):
+        try:
+            entries = [entry for entry in os.scandir(f"{self.directory}/sessions") if entry.name.endswith(".json.gz")]
+        except OSError:
+            return []
+        return [entry.name[:-len(".json.gz")] for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime, reverse=True)]
+
+    def save(self, name, gemini):
+        contents = [{"r": content.role, "p": [dumped for part in content.parts or [] if (dumped := self._dump_part(gemini, part))]} for content in gemini.contents]
+        record = {
+            "version": 1,
+            "model": gemini.model.short_name,
+            "system_instruction": gemini.system_instruction,
+            "tools_state": gemini.tools_state,
+            "contents": [content for content in contents if content["p"]],
+        }
+        path = self.session_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with gzip.open(tmp_path, "wt") as f:
+            json.dump(record, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+    def _dump_part(self, gemini, part):
+        if isinstance(part, SavedUpload):
+            return part.record
+        # an attachment that is still loading is waited for, a rejected one is left out
+        if isinstance(part, DeferredPart) and part.digest is None:
+            if (part := part.resolve()) is None:
+                return None
+        if isinstance(part, DeferredPart):
+            return {"b": part.digest, "m": part.mime_type, "s": part.size}
+        if part.text is not None and not part.thought:
+            return {"t": part.text}
+        if part.inline_data:
+            digest = self.blobs.put(None, part.inline_data.data)
+            return {"b": digest, "m": part.inline_data.mime_type, "s": len(part.inline_data.data)}
+        if part.file_data:
+            return self._dump_file_data(gemini, part.file_data)
+        return {"j": part.model_dump_json(exclude_none=True)}
+
+    def _dump_file_data(self, gemini, file_data):
+        record = {"u": file_data.file_uri, "m": file_data.mime_type}
+        if not (found := gemini.upload_cache.find(file_data.file_uri)):
+            return record
+        digest, entry = found
+        record.update(d=digest, e=entry["expires"])
+        if (path := entry.get("path")) and os.path.isfile(path) and not path.startswith(self.blobs.directory):
+            record.update(f=path, s=os.path.getsize(path))
+        elif os.path.isfile(self.blobs.blob_path(digest)):
+            record["s"] = os.path.getsize(self.blobs.blob_path(digest))
+        elif os.path.isfile(cached := self.file_cache.blob_path(digest)):
+            self.blobs.put_file(cached, digest)
+            record["s"] = os.path.getsize(cached)
+        return record
+
+    def load(self, name, gemini):
+        with gzip.open(self.session_path(name), "rt") as f:
+            record = json.load(f)
+
+        gemini.clear_contents()
+        gemini.model = gemini.find_model(record["model"])
+        gemini.system_instruction = record["system_instruction"]
+        gemini.tools_state.update(record["tools_state"])
+        gemini.contents = [self._load_content(gemini, content) for content in record["contents"]]
+
+    def _load_content(self, gemini, content):
+        parts = [self._load_part(gemini, part) for part in content["p"]]
+        if any(isinstance(part, DeferredPart) for part in parts):
+            return DeferredContent(content["r"], parts)
+        return types.Content(role=content["r"], parts=parts)
+
+    def _load_part(self, gemini, part):
+        if "t" in part:
+            return types.Part.from_text(text=part["t"])
+        if "b" in part:
+            resolve = partial(gemini.make_file_part_from_path, self.blobs.blob_path(part["b"]), part["m"], part["b"], part["s"])
+            return DeferredPart(resolve, part["m"], size=part["s"], digest=part["b"], description=f"{part['m']} attachment")
+        if "u" in part and "d" in part:
+            return SavedUpload(partial(self._resolve_upload, gemini, part), part)
+        if "u" in part:
+            return types.Part(file_data=types.FileData(file_uri=part["u"], mime_type=part["m"]))
+        return types.Part.model_validate_json(part["j"])
+
+    # the saved uri while it is valid, otherwise the file is uploaded again.
+    # A file outside the blob directory must still have the saved content.
+    def _resolve_upload(self, gemini, record):
+        if entry := gemini.upload_cache.get(record["d"]):
+            return types.Part.from_uri(file_uri=entry["uri"], mime_type=entry["mime_type"])
+        if record["e"] > time.time() + 60:
+            return types.Part.from_uri(file_uri=record["u"], mime_type=record["m"])
+        if path := record.get("f"):
+            if filehandling.hash_file(path) != record["d"]:
+                raise ValueError(f"{path} changed since the session was saved")
+        else:
+            path = self.blobs.blob_path(record["d"])
+        if not os.path.isfile(path):
+            raise ValueError("the upload expired and the file was not kept")
+        return gemini.make_uploaded_part(record["d"], path, record["m"])
+
+
+# a Files API part of a resumed session, saved again as it was loaded
+class SavedUpload(DeferredPart):
+    def __init__(self, resolve, record) -> None:
+        super().__init__(resolve, record["m"], size=record.get("s"), digest=record["d"], description=f"uploaded {record['m']} file")
+        self.record = record
@@ -0,0 +1,179 @@
+################################################################################
+#  structured output: the model answers with json that follows a schema        #
+#  instead of markdown. A schema is a json schema file, or a pydantic model    #
+#  given as module:Model (module:Model[] asks for a list of them). The answer  #
+#  is parsed while it streams, every element of a top level array is          #
+#  validated as soon as it is complete.                                        #
+################################################################################
+import os, sys, json
+import importlib
+import functools
+from json_records import StreamingJsonExtractor
+
+
+class SchemaError(Exception):
+    pass
+
+
+json_types = {"object": dict, "array": list, "string": str, "integer": int, "number": (int, float), "boolean": bool, "null": type(None)}
+
+
+# checks the part of json schema the api accepts for response_json_schema:
+# type, enum, const, properties, required, additionalProperties, items,
+# min/maxItems, anyOf and local $refs
+def check(value, schema, root, path="$"):
+    if "$ref" in schema:
+        if not schema["$ref"].startswith("#/"):
+            raise SchemaError(f"{path}: only local $refs are supported, not {schema['$ref']}")
+        target = root
+        for key in schema["$ref"][2:].split("/"):
+            target = target[key]
+        return check(value, target, root, path)
+    if "anyOf" in schema:
+        errors = []
+        for option in schema["anyOf"]:
+            try:
+                return check(value, option, root, path)
+            except SchemaError as e:
+                errors.append(str(e))
+        raise SchemaError(" or ".join(errors))
+    if "type" in schema:
+        types = schema["type"] if isinstance(schema["type"], list) else [schema["type"]]
+        if schema.get("nullable"):
+            types = types + ["null"]
+        # bool is an int in python, not in json
+        if not any(isinstance(value, json_types.get(name, object)) and not (isinstance(value, bool) and name in ("integer", "number")) for name in types):
+            raise SchemaError(f"{path}: expected {' or '.join(types)}, got {json.dumps(value)[:40]}")
+    if "enum" in schema and value not in schema["enum"]:
+        raise SchemaError(f"{path}: {json.dumps(value)[:40]} is not one of {schema['enum']}")
+    if "const" in schema and value != schema["const"]:
+        raise SchemaError(f"{path}: expected {json.dumps(schema['const'])}")
+    if isinstance(value, dict):
+        properties = schema.get("properties", {})
+        for name in schema.get("required", ()):
+            if name not in value:
+                raise SchemaError(f"{path}: {name} is missing")
+        for name, item in value.items():
+            if name in properties:
+                check(item, properties[name], root, f"{path}.{name}")
+            elif schema.get("additionalProperties") is False:
+                raise SchemaError(f"{path}: unexpected property {name}")
+    if isinstance(value, list):
+        if len(value) < schema.get("minItems", 0) or len(value) > schema.get("maxItems", len(value)):
+            raise SchemaError(f"{path}: {len(value)} items")
+        if "items" in schema:
+            for index, item in enumerate(value):
+                check(item, schema["items"], root, f"{path}[{index}]")
+
+
+class Schema:
+    def __init__(self, name, json_schema, validate=None, validate_item=None) -> None:
+        self.name = name
+        self.json_schema = json_schema
+        self.is_array = json_schema.get("type") == "array"
+        self._validate = validate if validate else lambda value: check(value, json_schema, json_schema)
+        items = json_schema.get("items", {})
+        self._validate_item = validate_item if validate_item else lambda value: check(value, items, json_schema, "$[]")
+
+    def validate(self, value):
+        self._validate(value)
+        return value
+
+    # an element of a top level array, or the top level object
+    def validate_record(self, record):
+        (self._validate_item if self.is_array else self._validate)(record)
+        return record
+
+
+def from_json_schema(json_schema, name="schema"):
+    if not isinstance(json_schema, dict):
+        raise SchemaError(f"{name} is not a json schema object")
+    return Schema(name, json_schema)
+
+
+def from_model(model, name, as_list=False):
+    import pydantic
+    adapter = pydantic.TypeAdapter(list[model] if as_list else model)
+    item_adapter = pydantic.TypeAdapter(model)
+    def validate_with(adapter):
+        def validate(value):
+            try:
+                adapter.validate_python(value)
+            except pydantic.ValidationError as e:
+                error = e.errors()[0]
+                more = f" and {e.error_count() - 1} more" if e.error_count() > 1 else ""
+                raise SchemaError(f"{'.'.join(map(str, error['loc'])) or '$'}: {error['msg']}{more}") from e
+        return validate
+    return Schema(name, adapter.json_schema(), validate_with(adapter), validate_with(item_adapter))
+
+
+# spec is a json schema file, module:Model or module:Model[]. Modules are
+# looked up from the current directory as well.
+@functools.lru_cache(maxsize=32)
+def load(spec):
+    if os.path.isfile(spec):
+        try:
+            with open(spec) as f:
+                return from_json_schema(json.load(f), os.path.basename(spec))
+        except (OSError, ValueError) as e:
+            raise SchemaError(f"could not read schema {spec}: {e}") from e
+    module_name, _, model_name = spec.partition(":")
+    if not model_name:
+        raise SchemaError(f"{spec} is neither a json schema file nor module:Model")
+    as_list = model_name.endswith("[]")
+    model_name = model_name.removesuffix("[]")
+    if "" not in sys.path and os.getcwd() not in sys.path:
+        sys.path.append(os.getcwd())
+    try:
+        model = getattr(importlib.import_module(module_name), model_name)
+    except (ImportError, AttributeError) as e:
+        raise SchemaError(f"could not import {spec}: {e}") from e
+    try:
+        return from_model(model, spec, as_list)
+    except Exception as e:
+        raise SchemaError(f"{spec} is not a pydantic model: {e}") from e
+
+
+# a schema of a batch line: a json schema object or a spec string
+def make(value):
+    return from_json_schema(value) if isinstance(value, dict) else load(value)
+
+
+# parses the answer while it arrives. feed returns the records that are
+# complete and valid, the invalid ones are collected in errors.
+class StructuredStream:
+    def __init__(self, schema) -> None:
+        self.schema = schema
+        self.extractor = StreamingJsonExtractor(fenced=False)
+        self.records = []
+        self.errors = []
+        self._fragments = []
+
+    def feed(self, text):
+        self._fragments.append(text)
+        valid = []
+        for record in self.extractor.feed(text):
+            try:
+                valid.append(self.schema.validate_record(record))
+            except SchemaError as e:
+                self.errors.append(f"record {len(self.records) + len(self.errors) + 1}: {e}")
+                continue
+            self.records.append(valid[-1])
+        return valid
+
+    # the complete answer, raises SchemaError if it is no valid json or does
+    # not match the schema. The records were validated already, a top level
+    # array is made of them instead of parsing the answer again.
+    def finish(self):
+        if self.errors:
+            raise SchemaError(self.errors[0] + (f" and {len(self.errors) - 1} more" if len(self.errors) > 1 else ""))
+        if self.extractor.closed == 1 and not self.extractor.errors:
+            if self.schema.is_array and self.extractor.top_level == "[":
+                return self.records
+            if not self.schema.is_array and self.extractor.top_level == "{":
+                return self.records[0]
+        try:
+            value = json.loads("".join(self._fragments))
+        except ValueError as e:
+            raise SchemaError(f"the answer is no valid json: {e}") from e
+        return self.schema.validate(value)